@@ -0,0 +1,114 @@
+'''board
+Storage of the board state.
+
+The board is held as a flat uint8 numpy array of color ids, indexed by the linear index of the tile
+(lind = (row - 1) * width + (column - 1)).
+BoardStateView exposes this array with the interface of the list that used to hold the board state.
+
+Boards are hashed with Zobrist hashing: every (lind, color id) pair is assigned a random 64-bit key,
+and the hash of a board is the XOR of the keys of its tiles. Changing the color of a tile changes the hash
+by the XOR of two keys, so the hash of a board can be kept up to date as it is drawn on.
+'''
+
+from collections.abc import Sequence
+from functools import lru_cache
+import numpy as np
+
+from constants.constants import COLORS
+
+BOARD_DTYPE = np.uint8
+
+# the keys are drawn from a fixed seed, so hashes are the same in every run
+_ZOBRIST_SEED = 20220119
+
+def new_board(width, height):
+  '''Return a blank (all white) board array'''
+  return np.zeros(width * height, dtype=BOARD_DTYPE)
+
+@lru_cache(maxsize=None)
+def zobrist_table(size):
+  '''Return a (size, number of colors) uint64 array with the key of every (lind, color id) pair.
+  The keys of a smaller board are the first rows of the keys of a bigger board'''
+
+  keys = np.random.default_rng(_ZOBRIST_SEED).integers(0, 2 ** 64, size=(size, len(COLORS)), dtype=np.uint64)
+  keys.flags.writeable = False
+  return keys
+
+def board_hash(board):
+  '''Return the Zobrist hash of a board (a list or an array of color ids), as a python int'''
+
+  board = np.asarray(board, dtype=np.int64)
+  return int(np.bitwise_xor.reduce(zobrist_table(len(board))[np.arange(len(board)), board]))
+
+@lru_cache(maxsize=None)
+def blank_board_hash(size):
+  '''Return the Zobrist hash of a blank board with 'size' tiles'''
+
+  return board_hash(np.zeros(size, dtype=BOARD_DTYPE))
+
+def hash_changes(keys, linds, old, new):
+  '''Return the XOR that updates the hash of a board when the tiles at 'linds' change color from 'old' to 'new'
+  (arrays of color ids), where 'keys' is the zobrist_table of the board. The linds should not repeat'''
+
+  if not len(linds):
+    return 0
+  return int(np.bitwise_xor.reduce(keys[linds, old] ^ keys[linds, new]))
+
+class BoardStateView(Sequence):
+  '''A list-compatible view of a board array.
+  Reading returns python ints, writing goes directly to the underlying array.
+  If 'on_write' is given, it is called after every write with the index that was written
+  and the previous values at that index.
+  '''
+
+  def __init__(self, board, on_write=None):
+    self._board = board
+    self._on_write = on_write
+
+  def __len__(self):
+    return len(self._board)
+
+  def __getitem__(self, item):
+    if isinstance(item, slice):
+      return self._board[item].tolist()
+    return int(self._board[item])
+
+  def __setitem__(self, item, value):
+    if self._on_write is None:
+      self._board[item] = value
+    else:
+      old = self._board[item].copy()
+      self._board[item] = value
+      self._on_write(item, old)
+
+  def __iter__(self):
+    return iter(self._board.tolist())
+
+  def __eq__(self, other):
+    if isinstance(other, BoardStateView):
+      other = other._board
+    if isinstance(other, np.ndarray):
+      return self._board.shape == other.shape and bool(np.all(self._board == other))
+    if isinstance(other, Sequence):
+      return self.tolist() == list(other)
+    return NotImplemented
+
+  def __repr__(self):
+    return repr(self.tolist())
+
+  def __array__(self, dtype=None, copy=None):
+    '''Return the board as an array: a read-only view, so that writes go through __setitem__
+    (and are recorded), or a copy if 'copy' is True or another dtype is asked for'''
+
+    if copy or (dtype is not None and np.dtype(dtype) != self._board.dtype):
+      return self._board.astype(self._board.dtype if dtype is None else dtype)
+    view = self._board.view()
+    view.flags.writeable = False
+    return view
+
+  def __copy__(self):
+    return self.tolist()
+
+  def tolist(self):
+    '''Return a copy of the board state as a list of color ids'''
+    return self._board.tolist()
@@ -0,0 +1,186 @@
+'''board_batch
+Evaluation of many boards at once.
+
+BoardBatch holds N boards of the same size as an (N, H*W) uint8 array of color ids, indexed by (board, lind),
+and answers questions about all the boards with array operations over the batch dimension.
+Neighbors are taken from the same adjacency table as the single-board engine (hex_arrays.neighbor_table).
+'''
+
+import numpy as np
+
+from constants.constants import COLORS, DIRECTIONS, HEIGHT, WIDTH
+from src.board import BOARD_DTYPE
+from src.hex_arrays import neighbor_table
+
+class BoardBatch:
+  '''A batch of boards of the same size
+
+  Parameters:
+  ---------------
+  boards: array-like
+    The boards, as an (N, H*W) or (N, H, W) array of color ids, or a list of boards (lists of color ids)
+  width, height: int
+    The size of the boards
+  keys: List
+    Optional labels of the boards, e.g. (task index, step number) pairs
+  '''
+
+  def __init__(self, boards, width=WIDTH, height=HEIGHT, keys=None):
+    self.width = width
+    self.height = height
+    self.boards = np.asarray(boards, dtype=BOARD_DTYPE).reshape(-1, width * height)
+    self.keys = list(keys) if keys is not None else None
+    self._neighbor_linds = neighbor_table(width, height)
+
+  def from_tasks(tasks):
+    '''Construct a BoardBatch from the gold boards of the given tasks (see utils.reading_tasks.read_tasks).
+    The keys of the boards are (task index, step number) pairs, with steps numbered from 1'''
+
+    # utils depends on src, so it is imported only here
+    from utils.reading_tasks import extract_boards
+
+    boards, keys = [], []
+    for task in tasks:
+      for step, board in enumerate(extract_boards(task), start=1):
+        boards.append(board)
+        keys.append((task['index'], step))
+    return BoardBatch(np.array(boards, dtype=BOARD_DTYPE).reshape(-1, WIDTH * HEIGHT), keys=keys)
+
+  def __len__(self):
+    return len(self.boards)
+
+  def __getitem__(self, item):
+    '''Return the board(s) at 'item' as an array, or a BoardBatch for a slice or an array of indices'''
+
+    if isinstance(item, (int, np.integer)):
+      return self.boards[item]
+    keys = None if self.keys is None else [self.keys[i] for i in np.arange(len(self))[item].tolist()]
+    return BoardBatch(self.boards[item], self.width, self.height, keys)
+
+  def grids(self):
+    '''Return the boards as an (N, H, W) array (a view)'''
+
+    return self.boards.reshape(-1, self.height, self.width)
+
+  def get_color(self, color):
+    '''Return an (N, H*W) boolean array, True at the tiles of the given color'''
+
+    return self.boards == COLORS.index(color)
+
+  def gather_neighbors(self, values=None, fill=-1):
+    '''Gather the values of the neighbors of every tile
+
+    Parameters:
+    ---------------
+    values: np.ndarray
+      An (N, H*W) array of values over the boards. Default: the color ids of the boards
+    fill:
+      The value of neighbors that are not on the board
+
+    Returns:
+    ---------------
+    np.ndarray
+      An (N, H*W, 6) array, whose columns follow the order of DIRECTIONS
+    '''
+
+    values = self.boards if values is None else np.asarray(values)
+    # a type that holds both the values and 'fill' (e.g. int16 for color ids and -1)
+    dtype = np.promote_types(values.dtype, np.min_scalar_type(fill))
+    # lind -1 (off-board) picks the appended fill value
+    padded = np.concatenate([values.astype(dtype, copy=False), np.full((len(values), 1), fill, dtype=dtype)], axis=1)
+    return padded[:, self._neighbor_linds]
+
+  def neighbor(self, values, direction, fill=-1):
+    '''Return an (N, H*W) array with the value of the neighbor of every tile in the given direction'''
+
+    return self.gather_neighbors(values, fill)[:, :, list(DIRECTIONS).index(direction)]
+
+  def touching(self, color, other_color):
+    '''Return an (N, H*W) boolean array, True at the tiles of 'color' that have a neighbor of 'other_color'
+    (e.g. the red tiles that border blue tiles)'''
+
+    return self.get_color(color) & self.gather_neighbors(self.get_color(other_color), fill=False).any(axis=2)
+
+  def label_regions(self, color=None):
+    '''Label the connected regions of the boards: maximal sets of neighboring tiles of the same color.
+    Only the regions of 'color' are labeled if it is given, and only the regions that are not white otherwise.
+    Labels are propagated between neighbors on all the boards at once, with pointer jumping,
+    so the number of iterations grows with the logarithm of the regions' size rather than with their size.
+
+    Returns:
+    ---------------
+    labels: np.ndarray
+      An (N, H*W) int array. Tiles in a region are labeled 1, 2, ... in each board, in the order of the region's
+      first tile, and the other tiles are labeled 0
+    num_regions: np.ndarray
+      An (N,) int array with the number of regions in every board
+    '''
+
+    num_boards, size = self.boards.shape
+    in_region = self.boards != 0 if color is None else self.get_color(color)
+    # the label of a tile is the flat index (board * size + lind) of a tile in its region, -1 outside regions
+    flat = np.arange(num_boards * size).reshape(num_boards, size)
+    parents = np.where(in_region, flat, -1).reshape(-1)
+    neighbor_colors = self.gather_neighbors()
+    same_region = in_region[:, :, None] & (neighbor_colors == self.boards[:, :, None])
+    neighbor_flat = flat[:, :1, None] + self._neighbor_linds[None, :, :]
+    # tiles that are not in the same region point to themselves
+    neighbor_flat = np.where(same_region, neighbor_flat, flat[:, :, None]).reshape(-1, len(DIRECTIONS))
+    tiles = np.flatnonzero(parents >= 0)
+    neighbor_flat = neighbor_flat[tiles]
+    previous = None
+    while previous is None or not np.array_equal(parents[tiles], previous):
+      previous = parents[tiles]
+      roots = np.minimum(previous, parents[neighbor_flat].min(axis=1))
+      # hook the current roots to the smaller roots, then jump to the roots' roots
+      np.minimum.at(parents, previous, roots)
+      parents[tiles] = parents[parents[tiles]]
+    labels = np.zeros(num_boards * size, dtype=np.int64)
+    is_root = np.zeros(num_boards * size, dtype=bool)
+    is_root[tiles] = parents[tiles] == tiles
+    # number the roots of every board 1, 2, ... in order
+    root_numbers = np.cumsum(is_root.reshape(num_boards, size), axis=1).reshape(-1)
+    labels[tiles] = root_numbers[parents[tiles]]
+    return labels.reshape(num_boards, size), is_root.reshape(num_boards, size).sum(axis=1)
+
+  def color_counts(self):
+    '''Return an (N, number of colors) int array with the number of tiles of every color in every board'''
+
+    offsets = np.arange(len(self.boards))[:, None] * len(COLORS)
+    counts = np.bincount((self.boards + offsets).reshape(-1), minlength=len(self.boards) * len(COLORS))
+    return counts.reshape(len(self.boards), len(COLORS))
+
+  def diff(self, other):
+    '''Return an (N, H*W) boolean array, True at the tiles whose color differs from 'other'
+    (a BoardBatch or an array of boards, or a single board to compare with all the boards)'''
+
+    if isinstance(other, BoardBatch):
+      other = other.boards
+    other = np.asarray(other, dtype=BOARD_DTYPE)
+    return self.boards != other.reshape(-1, self.boards.shape[1])
+
+  def num_differences(self, other):
+    '''Return an (N,) int array with the number of tiles whose color differs from 'other' (see diff)'''
+
+    return self.diff(other).sum(axis=1)
+
+  def matches(self, other):
+    '''Return an (N,) boolean array, True for the boards that are equal to 'other' (see diff)'''
+
+    return ~self.diff(other).any(axis=1)
+
+  def precision_recall(self, gold):
+    '''Compare the painted (not white) tiles of the boards with the painted tiles of gold boards (see diff):
+    precision is the fraction of the painted tiles that have the gold color,
+    recall is the fraction of the painted gold tiles that have the gold color.
+    Returns two (N,) float arrays. Boards with no painted tiles have precision 1, and likewise for recall'''
+
+    if isinstance(gold, BoardBatch):
+      gold = gold.boards
+    gold = np.asarray(gold, dtype=BOARD_DTYPE).reshape(-1, self.boards.shape[1])
+    correct = ((self.boards == gold) & (gold != 0)).sum(axis=1)
+    painted = (self.boards != 0).sum(axis=1)
+    gold_painted = np.broadcast_to((gold != 0).sum(axis=1), painted.shape)
+    precision = np.where(painted > 0, correct / np.maximum(painted, 1), 1.0)
+    recall = np.where(gold_painted > 0, correct / np.maximum(gold_painted, 1), 1.0)
+    return precision, recall
@@ -0,0 +1,270 @@
+'''hex_arrays
+Array-level helpers for the hexagons board.
+
+Tiles on the board are addressed by their linear index (lind = (row - 1) * width + (column - 1)).
+A set of on-board tiles is represented by a bitmask: a python int in which bit 'lind' is set
+iff the tile is in the set.
+'''
+
+from functools import lru_cache
+import numpy as np
+
+from constants.constants import DIRECTIONS
+
+# below this number of linds, building a bitmask in python is faster than going through numpy
+_SMALL_SET = 32
+
+# boards with up to this number of tiles have a precomputed distance matrix (8 MB at most)
+_DISTANCE_MATRIX_TILES = 2048
+
+def linds_to_mask(linds, size):
+  '''Return the bitmask of a collection of linear indices on a board with 'size' tiles'''
+
+  if len(linds) < _SMALL_SET:
+    mask = 0
+    for lind in linds:
+      mask |= 1 << int(lind)
+    return mask
+  bits = np.zeros(size, dtype=bool)
+  bits[np.asarray(linds, dtype=np.int64)] = True
+  return int.from_bytes(np.packbits(bits, bitorder='little').tobytes(), 'little')
+
+def mask_to_linds(mask, size):
+  '''Return the sorted array of linear indices whose bits are set in the bitmask'''
+
+  if mask == 0:
+    return np.zeros(0, dtype=np.int64)
+  return np.flatnonzero(mask_to_bits(mask, size))
+
+def mask_size(mask):
+  '''Return the number of set bits in the bitmask'''
+
+  return bin(mask).count('1')
+
+def mask_to_bits(mask, size):
+  '''Return a boolean array of length 'size', True at the linear indices whose bits are set in the bitmask'''
+
+  num_bytes = (size + 7) // 8
+  bits = np.unpackbits(np.frombuffer(mask.to_bytes(num_bytes, 'little'), dtype=np.uint8), bitorder='little')
+  return bits[:size].astype(bool)
+
+def _read_only(array):
+  array.flags.writeable = False
+  return array
+
+def offsets_to_cubes(columns, rows):
+  '''Return an (n, 3) int array with the cube coordinates of the tiles at the given columns and rows
+  (int arrays, numbered from 1). Odd columns (in 1-based numbering) are the higher ones'''
+
+  q = np.asarray(columns, dtype=np.int64) - 1
+  r = np.asarray(rows, dtype=np.int64) - 1 - (q - (q % 2)) // 2
+  return np.stack([q, r, -q - r], axis=-1)
+
+def cubes_to_offsets(cubes):
+  '''Return the columns and the rows (int arrays, numbered from 1) of an (n, 3) array of cube coordinates'''
+
+  cubes = np.asarray(cubes, dtype=np.int64).reshape(-1, 3)
+  q, r = cubes[:, 0], cubes[:, 1]
+  return q + 1, r + (q - (q % 2)) // 2 + 1
+
+def linds_to_offsets(linds, width):
+  '''Return the columns and the rows (int arrays, numbered from 1) of an array of linear indices'''
+
+  linds = np.asarray(linds, dtype=np.int64)
+  return linds % width + 1, linds // width + 1
+
+def on_board(columns, rows, width, height):
+  '''Return a boolean array, True where the column and the row are on the board'''
+
+  columns, rows = np.asarray(columns), np.asarray(rows)
+  return (1 <= columns) & (columns <= width) & (1 <= rows) & (rows <= height)
+
+def offsets_to_linds(columns, rows, width, height):
+  '''Return the linear indices of the tiles at the given columns and rows, and -1 for tiles that are not on the board'''
+
+  columns, rows = np.asarray(columns, dtype=np.int64), np.asarray(rows, dtype=np.int64)
+  return np.where(on_board(columns, rows, width, height), (rows - 1) * width + columns - 1, -1)
+
+def cubes_to_linds(cubes, width, height):
+  '''Return the linear indices of an (n, 3) array of cube coordinates, and -1 for tiles that are not on the board'''
+
+  return offsets_to_linds(*cubes_to_offsets(cubes), width, height)
+
+@lru_cache(maxsize=None)
+def offset_table(width, height):
+  '''Return an (N, 2) int array with the column and the row of every tile on the board, indexed by lind'''
+
+  return _read_only(np.stack(linds_to_offsets(np.arange(width * height), width), axis=1))
+
+@lru_cache(maxsize=None)
+def cube_table(width, height):
+  '''Return an (N, 3) int array with the cube coordinates of every tile on the board, indexed by lind'''
+
+  return _read_only(offsets_to_cubes(*offset_table(width, height).T))
+
+@lru_cache(maxsize=None)
+def neighbor_table(width, height):
+  '''Return an (N, 6) int array with the linear indices of the neighbors of every tile on the board.
+  Columns follow the order of DIRECTIONS, and a neighbor that is not on the board is marked by -1'''
+
+  cubes = cube_table(width, height)
+  neighbors = np.stack([cubes_to_linds(cubes + np.array(direction_cube), width, height)
+                        for direction_cube in DIRECTIONS.values()], axis=1)
+  return _read_only(neighbors)
+
+@lru_cache(maxsize=None)
+def neighbor_cubes(width, height):
+  '''Return a dict from the cube coordinates of every tile on the board to the cube coordinates of its neighbors,
+  in the order of DIRECTIONS. Neighbors that are not on the board are included'''
+
+  cubes = cube_table(width, height)
+  neighbors = cubes[:, None, :] + np.array(list(DIRECTIONS.values()))
+  return {tuple(cube): tuple(map(tuple, cube_neighbors)) for cube, cube_neighbors in zip(cubes.tolist(), neighbors.tolist())}
+
+def bits_to_mask(bits):
+  '''Return the bitmask of a boolean array over the board'''
+
+  return int.from_bytes(np.packbits(bits, bitorder='little').tobytes(), 'little')
+
+@lru_cache(maxsize=None)
+def perimeter_bits(width, height):
+  '''Return a boolean array over the board, True at the tiles on the board's perimeter'''
+
+  bits = np.zeros((height, width), dtype=bool)
+  bits[[0, -1], :] = True
+  bits[:, [0, -1]] = True
+  return _read_only(bits.reshape(-1))
+
+def flood_fill(seed_bits, passable_bits, neighbor_linds):
+  '''Return a boolean array over the board, True at the tiles that can be reached from the seeds
+  by moving between neighboring passable tiles. Only passable seeds are used'''
+
+  reached = seed_bits & passable_bits
+  frontier = np.flatnonzero(reached)
+  while frontier.size:
+    candidates = neighbor_linds[frontier].reshape(-1)
+    candidates = candidates[candidates >= 0]
+    candidates = np.unique(candidates[passable_bits[candidates] & ~reached[candidates]])
+    reached[candidates] = True
+    frontier = candidates
+  return reached
+
+class Regions:
+  '''Partition of the board with respect to a shape, computed with a single flood fill from the perimeter
+
+  Attributes (boolean arrays over the board):
+  ---------------
+  outside: tiles not in the shape that can be reached from the board's perimeter without crossing the shape
+  inside: tiles not in the shape that are not outside
+  '''
+
+  def __init__(self, shape_bits, width, height):
+    neighbor_linds = neighbor_table(width, height)
+    self.outside = flood_fill(perimeter_bits(width, height), ~shape_bits, neighbor_linds)
+    self.inside = ~shape_bits & ~self.outside
+
+@lru_cache(maxsize=None)
+def axis_lines(width, height, axis):
+  '''Return the lines of the board on which the cube coordinate 'axis' is constant, as a triple
+  (first, starts, linds): the line on which the coordinate equals v holds the tiles
+  linds[starts[v - first]:starts[v - first + 1]], sorted by the next cube coordinate ((axis + 1) % 3)'''
+
+  cubes = cube_table(width, height)
+  values = cubes[:, axis]
+  linds = np.lexsort((cubes[:, (axis + 1) % 3], values))
+  first = int(values.min())
+  starts = np.concatenate([[0], np.cumsum(np.bincount(values - first))])
+  return first, _read_only(starts), _read_only(linds)
+
+def line_extremes(values, coordinates, grows):
+  '''Group points by their line value, and return the sorted line values and for each line the position
+  (in the input) of the point with the largest coordinate if 'grows', or the smallest otherwise'''
+
+  values = np.asarray(values)
+  order = np.lexsort((coordinates, values))
+  sorted_values = values[order]
+  if not len(values):
+    return sorted_values, order
+  if grows:
+    is_extreme = np.append(sorted_values[1:] != sorted_values[:-1], True)
+  else:
+    is_extreme = np.insert(sorted_values[1:] != sorted_values[:-1], 0, True)
+  return sorted_values[is_extreme], order[is_extreme]
+
+def lines_beyond(width, height, axis, values, bounds, grows):
+  '''Return the linear indices of the tiles on the lines with the given values of the cube coordinate 'axis',
+  whose next cube coordinate is greater than the line's bound if 'grows', or smaller otherwise'''
+
+  first, starts, linds = axis_lines(width, height, axis)
+  cubes = cube_table(width, height)
+  next_axis = (axis + 1) % 3
+  parts = []
+  for value, bound in zip(values.tolist(), bounds.tolist()):
+    i = int(value) - first
+    if value != int(value) or not 0 <= i < len(starts) - 1:
+      # the line doesn't cross the board
+      continue
+    line = linds[starts[i]:starts[i + 1]]
+    if grows:
+      parts.append(line[np.searchsorted(cubes[line, next_axis], bound, side='right'):])
+    else:
+      parts.append(line[:np.searchsorted(cubes[line, next_axis], bound, side='left')])
+  return np.concatenate(parts) if parts else np.zeros(0, dtype=np.int64)
+
+def rotate_cubes(cubes, center, angle):
+  '''Rotate an (n, 3) array of cube coordinates around the cube 'center' by 'angle' degrees counterclockwise.
+  The angle should be a multiple of 60, so the rotation is exact: by 60 degrees, (q, r, s) maps to (-s, -q, -r)'''
+
+  if angle % 60 != 0:
+    raise Exception(f'angle {angle} is not a multiple of 60')
+  k = int(angle // 60) % 6
+  center = np.asarray(center)
+  return np.roll(np.asarray(cubes) - center, k, axis=-1) * (-1) ** k + center
+
+def cube_rotations(cubes, center):
+  '''Return a (6, n, 3) array with the rotations of an (n, 3) array of cube coordinates around the cube 'center'
+  by 0, 60, ..., 300 degrees counterclockwise'''
+
+  return np.stack([rotate_cubes(cubes, center, 60 * k) for k in range(6)])
+
+def reflect_cubes(cubes, normal, pivot):
+  '''Reflect an (n, 3) array of cube coordinates through the line that passes through the cube 'pivot'
+  and is perpendicular to the integer vector 'normal'.
+  Points on the hexagonal lattice are mapped exactly: v -> v - 2 (v . normal) normal / (normal . normal)'''
+
+  cubes = np.asarray(cubes)
+  normal = np.asarray(normal)
+  projections = (cubes - np.asarray(pivot)) @ normal
+  return cubes - (2 * projections)[:, None] * normal // (normal @ normal)
+
+def cube_distances(cubes1, cubes2):
+  '''Return the (n, m) int array of the hex distances between an (n, 3) and an (m, 3) array of cube coordinates'''
+
+  cubes1 = np.asarray(cubes1, dtype=np.int64).reshape(-1, 3)
+  cubes2 = np.asarray(cubes2, dtype=np.int64).reshape(-1, 3)
+  return np.abs(cubes1[:, None, :] - cubes2[None, :, :]).max(axis=2)
+
+@lru_cache(maxsize=None)
+def distance_matrix(width, height):
+  '''Return the (N, N) int16 array of the hex distances between the tiles of the board, indexed by lind,
+  or None if the board has more than _DISTANCE_MATRIX_TILES tiles'''
+
+  if width * height > _DISTANCE_MATRIX_TILES:
+    return None
+  cubes = cube_table(width, height)
+  return _read_only(cube_distances(cubes, cubes).astype(np.int16))
+
+def distances_to_set(linds, width, height):
+  '''Return an (N,) int array with the hex distance of every tile on the board to the nearest of the tiles 'linds'.
+  The distance to an empty set is -1'''
+
+  matrix = distance_matrix(width, height)
+  if not len(linds):
+    return np.full(width * height, -1, dtype=np.int64)
+  if matrix is not None:
+    return matrix[linds].min(axis=0).astype(np.int64)
+  cubes = cube_table(width, height)
+  # without a matrix the distances are computed in chunks of rows, to bound the memory of the (rows, N, 3) differences
+  chunk = max(1, _DISTANCE_MATRIX_TILES ** 2 // (8 * len(cubes)))
+  return np.minimum.reduce([cube_distances(cubes[linds[start:start + chunk]], cubes).min(axis=0)
+                            for start in range(0, len(linds), chunk)])
@@ -4,8 +4,9 @@ This module contains tools for drawing on a hexagons board.
 The purpose of these tools is to translate drawing instructions given in natural language
 into code.
 
-Contains 7 classes:
-- HexagonsGame - manages the board
+Contains 8 classes:
+- GameSession - the state of one board
+- HexagonsGame - manages the board of the active session
 - _Vec (for internal use only)
 - _Hexagon (for internal use only)
 - Shape - manages shapes (any set of tiles) on the board
@@ -15,31 +16,290 @@ Contains 7 classes:
 - Triangle(Shape) - a triangle on the board
 '''
 
-from copy import copy
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+import inspect
+from itertools import count
 import numpy as np
-from scipy.spatial.transform import Rotation
 from typing import Callable, Optional, List  # Union
 
 from constants.constants import COLORS, WIDTH, HEIGHT, DIRECTIONS
-import src.plot_board as pb
-from utils.reading_tasks import read_task
+from src.board import BOARD_DTYPE, BoardStateView, blank_board_hash, hash_changes, new_board, zobrist_table
+from src.hex_arrays import Regions, bits_to_mask, cube_distances, cube_rotations, cube_table, cubes_to_offsets, \
+  distances_to_set, line_extremes, lines_beyond, linds_to_mask, mask_to_linds, mask_to_bits, mask_size, neighbor_cubes, neighbor_table, reflect_cubes, rotate_cubes
+from src.history import BoardHistory, DrawEvent, DrawJournal, DrawRecordView, PendingDraws, StepBoardsView, UndoBuffer, UndoEntry
+from src.query_cache import QueryCache
 
-class HexagonsGame:
+# the board version changes whenever a board is started or drawn on, and is used to invalidate cached views.
+# The counter is shared by all sessions, so versions of different sessions never collide
+_version_counter = count()
+
+class GameSession:
+  '''Class GameSession holds the state of one board: its size, the board itself and the records of steps and batches.
+  The attributes of the active session are accessed as attributes of HexagonsGame (e.g. HexagonsGame.board_state).
+
+  Parameters:
+  ---------------
+  width, height: int
+    The size of the board
+  lazy: bool
+    If True, draws are applied to the board only when the board or the records are read (see HexagonsGame.set_lazy)
+  '''
+
+  __slots__ = ('width', 'height', '_board_start_version', '_board_version', '_board', 'board_state',
+               '_hexagons_by_lind', '_hexagons_by_cube', '_neighbor_linds', '_history', 'board_states',
+               '_current_step_name', '_current_batch_name', '_journal', '_undo', '_observers', '_pending',
+               '_lazy', '_zobrist_keys', '_hash')
+
+  # the attributes that depend on the draws made so far: in a batch or in lazy mode, the pending draws are applied
+  # before these attributes are accessed through HexagonsGame
+  _BATCH_BARRIER = frozenset(['_board_version', '_board', 'board_state', '_history', 'board_states',
+                              '_current_step_name', '_current_batch_name', '_journal', '_undo', '_hash'])
+
+  def __init__(self, width=WIDTH, height=HEIGHT, lazy=False):
+    self.width = width
+    self.height = height
+    self._board_start_version = self._board_version = next(_version_counter)
+    self._board = new_board(width, height)
+    self.board_state = BoardStateView(self._board, on_write=self._board_written)
+    self._hexagons_by_lind, self._hexagons_by_cube = _Hexagon._interned_table(width, height)
+    self._neighbor_linds = neighbor_table(width, height)
+    self._history = BoardHistory(width * height)
+    # the board at the end of every step, read from the history
+    self.board_states = StepBoardsView(self._history)
+    self._current_step_name = None
+    self._current_batch_name = None
+    # the tiles drawn during recorded steps and batches
+    self._journal = DrawJournal()
+    self._undo = UndoBuffer()
+    # callbacks called with a DrawEvent after every draw
+    self._observers = ()
+    # the draws that were not applied yet in a batch or in lazy mode, None otherwise
+    self._lazy = lazy
+    self._pending = PendingDraws(width * height) if lazy else None
+    # the Zobrist hash of the board, updated with the changes of every draw
+    self._zobrist_keys = zobrist_table(width * height)
+    self._hash = blank_board_hash(width * height)
+
+  def subscribe(self, callback):
+    '''Call 'callback' with a DrawEvent after every draw on this board: one event per call of Shape.draw,
+    Shape.copy_paste, Shape.recolor etc., per write to board_state and per undo or redo.
+    The event holds the tiles whose color changed, so the board can be followed without copying it
+
+    Parameters:
+    ---------------
+    callback: Callable[[DrawEvent], None]
+      The function to call. A function that is subscribed twice is called twice
+    '''
+
+    self._observers = self._observers + (callback,)
+
+  def unsubscribe(self, callback):
+    '''Stop calling a callback given to subscribe'''
+
+    observers = list(self._observers)
+    observers.remove(callback)
+    self._observers = tuple(observers)
+
+  def _notify(self, linds, old, new):
+    '''Send the changes of a draw to the observers'''
+
+    event = DrawEvent(linds, new, old, self._current_step_name)
+    for callback in self._observers:
+      callback(event)
+
+  def _board_changed(self):
+    '''Advance the board version, after the board is modified'''
+    self._board_version = next(_version_counter)
+
+  def _record_draw(self, linds, old, new, journal_start, unique=False):
+    '''Record a draw that wrote the colors 'new' to the given linds of the board (arrays), where 'old' holds
+    their colors before the draw, and 'journal_start' is the length of the journal before the draw.
+    'unique' tells that the linds don't repeat (see BoardHistory.record)'''
+
+    linds, old, new = self._history.record(linds, old, new, self._board, unique)
+    self._undo.push(UndoEntry(self._history.num_draws, journal_start, self._journal.current_step))
+    self._hash ^= hash_changes(self._zobrist_keys, linds, old, new)
+    self._board_changed()
+    if self._observers:
+      self._notify(linds, old, new)
+
+  def _record_tile(self, lind, old, new, journal_start):
+    '''Record a draw that wrote the color 'new' to the single tile 'lind', whose color was 'old' (ints).
+    See _record_draw'''
+
+    self._history.record_tile(lind, old, new, self._board)
+    self._undo.push(UndoEntry(self._history.num_draws, journal_start, self._journal.current_step))
+    if old != new:
+      self._hash ^= int(self._zobrist_keys[lind, old] ^ self._zobrist_keys[lind, new])
+    self._board_changed()
+    if self._observers:
+      linds = np.array([lind] if old != new else [], dtype=np.int64)
+      self._notify(linds, np.full(len(linds), old, dtype=BOARD_DTYPE), np.full(len(linds), new, dtype=BOARD_DTYPE))
+
+  def _apply_pending(self):
+    '''Apply the pending draws to the board, as a single draw'''
+
+    pending = self._pending
+    if pending is None or not pending.num_draws:
+      return
+    self._pending = PendingDraws(len(self._board))
+    linds, old = pending.apply(self._board)
+    journal_start = len(self._journal)
+    self._record_draw(linds, old, self._board[linds], journal_start, unique=True)
+    if self._journal.active:
+      drawn = pending.journal
+      self._journal.record(drawn.linds.values, drawn.rows.values, drawn.columns.values, drawn.colors.values)
+
+  def _board_written(self, item, old):
+    '''Record a direct write to board_state, at index 'item' of the board'''
+
+    linds = np.atleast_1d(np.arange(len(self._board))[item])
+    self._record_draw(linds, np.atleast_1d(old), self._board[linds], len(self._journal), unique=True)
+
+  def _write(self, linds, colors):
+    '''Write colors to the board (an array of color ids) at linds that don't repeat,
+    without recording it as a draw that can be undone'''
+
+    old = self._board[linds]
+    self._board[linds] = colors
+    linds, old, new = self._history.record(linds, old, colors, self._board, unique=True)
+    self._hash ^= hash_changes(self._zobrist_keys, linds, old, new)
+    self._board_changed()
+    if self._observers:
+      self._notify(linds, old, new)
+
+# the session that HexagonsGame works on, in the current thread / asyncio task
+_active_session = ContextVar('active_session', default=None)
+
+class _SessionBound(type):
+  '''Metaclass of HexagonsGame. Reading or writing an attribute of GameSession on HexagonsGame
+  reads or writes it on the active session'''
+
+  def __getattr__(cls, name):
+    if name in GameSession.__slots__:
+      session = HexagonsGame.current_session()
+      if session._pending is not None and name in GameSession._BATCH_BARRIER:
+        session._apply_pending()
+      return getattr(session, name)
+    raise AttributeError(f"type object '{cls.__name__}' has no attribute '{name}'")
+
+  def __setattr__(cls, name, value):
+    if name in GameSession.__slots__:
+      session = HexagonsGame.current_session()
+      if session._pending is not None and name in GameSession._BATCH_BARRIER:
+        session._apply_pending()
+      setattr(session, name, value)
+    else:
+      super().__setattr__(name, value)
+
+class HexagonsGame(metaclass=_SessionBound):
   '''Class HexagonsGame manages the board: reset the board, hold the board parameters and constants,
   hold the board state, keep track of drawing steps
+
+  The board state is kept in the active GameSession. Every thread and every asyncio task has its own
+  active session, set by start() or use_session(). Where no session was set, the last started session is used.
   '''
 
   # _COLORS_LIST = ['white', 'black', 'yellow', 'green', 'red', 'blue', 'purple', 'orange']
 
-  def start(width = WIDTH, height = HEIGHT):
-    HexagonsGame.width = width
-    HexagonsGame.height = height
-    HexagonsGame.board_state = [0] * width * height
-    HexagonsGame.board_states = {}
-    HexagonsGame._current_step_name = None
-    HexagonsGame._step_drawn_hexagons = {}
-    HexagonsGame._current_batch_name = None
-    HexagonsGame._batch_draws = {}
+  # the last started session, used where no session was set in the current context
+  _last_session = None
+
+  def start(width = WIDTH, height = HEIGHT, lazy = False):
+    '''Start a new blank board, and make it the active session in the current context.
+    If 'lazy' is True, the board starts in lazy mode (see set_lazy)
+
+    Returns:
+    ---------------
+    GameSession
+      The new session
+    '''
+
+    session = GameSession(width, height, lazy)
+    _active_session.set(session)
+    HexagonsGame._last_session = session
+    return session
+
+  def current_session():
+    '''Return the active session'''
+
+    session = _active_session.get()
+    if session is None:
+      session = HexagonsGame._last_session
+      if session is None:
+        raise AttributeError('no board was started, call HexagonsGame.start() first')
+    return session
+
+  @contextmanager
+  def use_session(session):
+    '''Make the given session the active one in the current context, until the end of the \'with\' block
+
+    Parameters:
+    ---------------
+    session: GameSession
+      A session returned by start(), or created directly
+    '''
+
+    token = _active_session.set(session)
+    try:
+      yield session
+    finally:
+      _active_session.reset(token)
+
+  @contextmanager
+  def batch():
+    '''Defer the draws on the active board until the end of the \'with\' block, and apply them as a single draw:
+    one write to the board, one entry in the history and in the undo buffer, and one event for the observers.
+    The resulting board and records are the same as without the batch. Reading the board or the records
+    through HexagonsGame in the block (e.g. Tile.color, Shape.get_color, record_step) first applies
+    the draws made so far. Nested batches are part of the outer batch.
+
+    Example:
+    ---------------
+    with HexagonsGame.batch():
+      for tile in tiles:
+        tile.draw('red')
+    '''
+
+    session = HexagonsGame.current_session()
+    if session._pending is not None:
+      yield
+      return
+    session._pending = PendingDraws(session.width * session.height)
+    try:
+      yield
+    finally:
+      session._apply_pending()
+      if not session._lazy:
+        session._pending = None
+
+  def set_lazy(lazy=True):
+    '''Turn the lazy mode of the active board on or off. In lazy mode, draws (including copy_paste, grid,
+    reflect, rotate and recolor) are kept as a list of operations, and are applied to the board when the board
+    or the records are read through HexagonsGame, e.g. by plot, board_state, Tile.color, get_color or record_step.
+    The operations are applied as a single draw: writes that are overwritten are skipped, and consecutive draws
+    are written together. The boards and the records are the same as in the default (eager) mode,
+    but undo() undoes all the draws applied together'''
+
+    session = HexagonsGame.current_session()
+    if lazy and session._pending is None:
+      session._pending = PendingDraws(session.width * session.height)
+    elif not lazy:
+      session._apply_pending()
+      session._pending = None
+    session._lazy = lazy
+
+  def subscribe(callback):
+    '''Call 'callback' with a DrawEvent after every draw on the active board (see GameSession.subscribe)'''
+
+    HexagonsGame.current_session().subscribe(callback)
+
+  def unsubscribe(callback):
+    '''Stop calling a callback given to subscribe'''
+
+    HexagonsGame.current_session().unsubscribe(callback)
 
   def _start_batch_record(batch_name):
     '''This is a method used to analyze a procedure, it is not meant to use as part of the game
@@ -53,7 +313,7 @@ class HexagonsGame:
       The name of the batch, should be a string or an integer
     '''
     HexagonsGame._current_batch_name = batch_name
-    HexagonsGame._batch_draws[batch_name] = []
+    HexagonsGame._journal.start_batch(batch_name)
 
   def _get_batch_record(batch_name):
     '''Retrieving a list of draw commands in a batch
@@ -65,12 +325,15 @@ class HexagonsGame:
 
     Returns:
     ---------------
-    List of dictionaries
-      Each dictionary describes a draw action, and has the folowing keys: ['index', 'row', 'column', 'color']
+    DrawRecordView
+      A list of dictionaries. Each dictionary describes a draw action, and has the folowing keys:
+      ['index', 'row', 'column', 'color']
       Note that if the tile is not on the board, 'index' will be None
+      The same data is available as arrays, in the attributes 'linds' (-1 if the tile is not on the board),
+      'rows', 'columns' and 'colors' (color ids)
     '''
 
-    return HexagonsGame._batch_draws[batch_name]
+    return DrawRecordView(HexagonsGame._journal, HexagonsGame._journal.batches[batch_name])
 
 
   def record_step(step_name):
@@ -84,9 +347,9 @@ class HexagonsGame:
       The name of the step, should be a string or an integer
     '''
     if HexagonsGame._current_step_name is not None:
-      HexagonsGame.board_states[HexagonsGame._current_step_name] = copy(HexagonsGame.board_state)
+      HexagonsGame._history.mark(HexagonsGame._current_step_name)
     HexagonsGame._current_step_name = step_name
-    HexagonsGame._step_drawn_hexagons[step_name] = []
+    HexagonsGame._journal.start_step(step_name)
 
   def get_record(step_names):
     '''Retrieving a shape consisting of the tiles drawn in previous step/steps
@@ -104,9 +367,256 @@ class HexagonsGame:
 
     if not isinstance(step_names, list):
       step_names = [step_names]
-    drawn_hexagons = [_ for step_name in step_names for _ in HexagonsGame._step_drawn_hexagons[step_name]]
+    journal = HexagonsGame._journal
+    entries = [journal.entries(journal.step_ids, journal.steps[step_name]) for step_name in step_names]
+    linds = np.concatenate([np.zeros(0, dtype=np.int32)] + [journal.linds.values[_] for _ in entries])
+    # tiles are kept in the order in which they were first drawn
+    positions = np.flatnonzero(linds >= 0)
+    unique_linds, first = np.unique(linds[positions], return_index=True)
+    by_lind = HexagonsGame._hexagons_by_lind
+    hexagons = dict(zip(positions[first].tolist(), [by_lind[_] for _ in unique_linds.tolist()]))
+    offboard_positions = np.flatnonzero(linds < 0).tolist()
+    if offboard_positions:
+      # off-board tiles are created anew, with the last color they were drawn with
+      rows = np.concatenate([journal.rows.values[_] for _ in entries]).tolist()
+      columns = np.concatenate([journal.columns.values[_] for _ in entries]).tolist()
+      colors = np.concatenate([journal.colors.values[_] for _ in entries]).tolist()
+      by_offset = {}
+      for i in offboard_positions:
+        offset = (columns[i], rows[i])
+        if offset not in by_offset:
+          by_offset[offset] = hexagons[i] = _Hexagon(column=offset[0], row=offset[1])
+        by_offset[offset]._saved_color_id = colors[i]
+    drawn_hexagons = [hexagons[i] for i in sorted(hexagons)]
     return Shape(drawn_hexagons, from_hexagons=True)
 
+  def board_hash():
+    '''Return the 64-bit Zobrist hash of the board state, which is kept up to date as the board is drawn on.
+    Equal boards have equal hashes, in every session and every run. Boards given as lists of color ids
+    (e.g. gold boards) are hashed the same way by src.board.board_hash'''
+
+    return HexagonsGame._hash
+
+  def num_draws():
+    '''Return the number of draws made since the board was started'''
+
+    return HexagonsGame._history.num_draws
+
+  def _draw_of_step(step_name):
+    '''Returns the number of draws at the end of a step. The current step ends now'''
+
+    if step_name == HexagonsGame._current_step_name:
+      return HexagonsGame._history.num_draws
+    if step_name not in HexagonsGame._history.marks:
+      raise KeyError(f'step {step_name} was not recorded')
+    return HexagonsGame._history.marks[step_name]
+
+  def board_at(step_name=None, draw=None):
+    '''Return the board state at the end of a step, or after a number of draws
+
+    Parameters:
+    ---------------
+    step_name: str or int
+      A recorded step. The board of the current step is the current board
+    draw: int
+      The number of draws since the board was started, between 0 and num_draws()
+
+    Returns:
+    ---------------
+    List[int]
+      The color ids of the tiles, by linear index
+    '''
+
+    if draw is None:
+      draw = HexagonsGame._draw_of_step(step_name)
+    return HexagonsGame._history.board_at(draw).tolist()
+
+  def diff_steps(step_name1, step_name2):
+    '''Return a shape of the tiles whose color differs between the boards at the end of two steps
+
+    Parameters:
+    ---------------
+    step_name1, step_name2: str or int
+      Recorded steps
+
+    Returns:
+    ---------------
+    Shape
+      New Shape object
+    '''
+
+    linds = HexagonsGame._history.diff(HexagonsGame._draw_of_step(step_name1),
+                                       HexagonsGame._draw_of_step(step_name2))[0]
+    return Shape.from_linds(linds)
+
+  def undo():
+    '''Undo the last draw. Only tiles on the board are restored.
+
+    Returns:
+    ---------------
+    bool
+      True if a draw was undone, False if there was no draw to undo
+    '''
+
+    session = HexagonsGame.current_session()
+    session._apply_pending()
+    if not session._undo.done:
+      return False
+    draw = session._undo.done.pop()
+    linds, old, _ = session._history.draw_changes(draw.draw)
+    session._write(linds, old)
+    session._undo.undone.append((draw, session._journal.pop_entries(draw.journal_start)))
+    return True
+
+  def redo():
+    '''Redo the last undone draw. Making a new draw drops the undone draws.
+
+    Returns:
+    ---------------
+    bool
+      True if a draw was redone, False if there was no draw to redo
+    '''
+
+    session = HexagonsGame.current_session()
+    session._apply_pending()
+    if not session._undo.undone:
+      return False
+    draw, journal_entries = session._undo.undone.pop()
+    linds, _, new = session._history.draw_changes(draw.draw)
+    session._write(linds, new)
+    session._journal.push_entries(journal_entries)
+    session._undo.done.append(draw)
+    return True
+
+  def undo_step():
+    '''Undo all the draws of the current step (see record_step), or all the draws if no step was recorded
+
+    Returns:
+    ---------------
+    int
+      The number of draws that were undone
+    '''
+
+    session = HexagonsGame.current_session()
+    session._apply_pending()
+    num_undone = 0
+    while session._undo.done and session._undo.done[-1].step_id == session._journal.current_step:
+      HexagonsGame.undo()
+      num_undone += 1
+    return num_undone
+
+  def set_undo_limit(limit):
+    '''Set the maximal number of draws that can be undone (1000 by default).
+    The changes of older draws are still kept in the history of the board'''
+
+    HexagonsGame.current_session()._undo.set_limit(limit)
+
+  def _draw_hexagons(hexagons, colors, unique=False):
+    '''Paint a sequence of hexagons with a single write to the board.
+    This is the common path of _Hexagon._draw, Shape.draw, Shape.copy_paste and Shape.recolor.
+
+    Parameters:
+    ---------------
+    hexagons: List[_Hexagon]
+      The hexagons to paint. Hexagons that are not on the board keep their color on the object.
+    colors: str, int or np.ndarray
+      A single color (name or id) for all the hexagons, or an array with a color id per hexagon
+    unique: bool
+      True if no hexagon repeats (e.g. the hexagons of a shape), which saves looking for repetitions
+    '''
+
+    if isinstance(colors, str):
+      color_ids = COLORS.index(colors)
+    else:
+      color_ids = colors
+    session = HexagonsGame.current_session()
+    if len(hexagons) == 1 and hexagons[0]._lind is not None and session._pending is None:
+      # a single tile on the board is read and written as a scalar
+      lind = hexagons[0]._lind
+      color_id = int(color_ids[0]) if isinstance(color_ids, np.ndarray) else color_ids
+      board, journal = session._board, session._journal
+      old = int(board[lind])
+      board[lind] = color_id
+      session._record_tile(lind, old, color_id, len(journal))
+      if journal.active:
+        journal.record([lind], [lind // session.width + 1], [lind % session.width + 1], color_id)
+      return
+    # the color ids of all the hexagons, before off-board hexagons are removed
+    drawn_color_ids = color_ids
+    linds = [hexagon._lind for hexagon in hexagons]
+    if None in linds:
+      on_board = np.array([lind is not None for lind in linds], dtype=bool)
+      for hexagon, color_id in zip(hexagons, np.broadcast_to(color_ids, on_board.shape)):
+        if hexagon._lind is None:
+          hexagon._saved_color_id = int(color_id)
+      linds = [lind for lind in linds if lind is not None]
+      if isinstance(color_ids, np.ndarray):
+        color_ids = color_ids[on_board]
+    linds = np.array(linds, dtype=np.int64)
+    if session._pending is None:
+      journal = session._journal
+      old = session._board[linds]
+      session._board[linds] = color_ids
+      if isinstance(color_ids, np.ndarray):
+        new = color_ids.astype(BOARD_DTYPE, copy=False)
+      else:
+        new = np.full(len(linds), color_ids, dtype=BOARD_DTYPE)
+      session._record_draw(linds, old, new, len(journal), unique)
+    else:
+      # in a batch, the draw is applied later (steps and batches are not started in the meantime)
+      journal = session._pending.journal
+      session._pending.add(linds, color_ids)
+    if session._journal.active:
+      if len(linds) == len(hexagons):
+        rows, columns = linds // session.width + 1, linds % session.width + 1
+      else:
+        linds = np.array([-1 if hexagon._lind is None else hexagon._lind for hexagon in hexagons], dtype=np.int64)
+        rows = [hexagon._row for hexagon in hexagons]
+        columns = [hexagon._column for hexagon in hexagons]
+      journal.record(linds, rows, columns, drawn_color_ids)
+
+  def _read_colors(linds):
+    '''Return the color ids of the given tiles on the board.
+    Pending draws are applied first only if they write to one of the tiles'''
+
+    session = HexagonsGame.current_session()
+    if session._pending is not None and session._pending.written[linds].any():
+      session._apply_pending()
+    return session._board[linds]
+
+  def _copy_hexagons(hexagons, new_hexagons):
+    '''Add a pending draw that copies the colors of a sequence of hexagons to a sequence of new hexagons,
+    in a batch or in lazy mode (see Shape._draw_copy). The colors of tiles on the board are read when
+    the draw is applied, except for tiles copied off the board, which are read now'''
+
+    session = HexagonsGame.current_session()
+    dst = np.array([-1 if hexagon._lind is None else hexagon._lind for hexagon in new_hexagons], dtype=np.int64)
+    src = np.array([-1 if hexagon._lind is None else hexagon._lind for hexagon in hexagons], dtype=np.int64)
+    colors = np.array([0 if hexagon._lind is not None else hexagon._saved_color_id for hexagon in hexagons],
+                      dtype=BOARD_DTYPE)
+    if not set(src.tolist()).isdisjoint(dst[dst >= 0].tolist()):
+      # a tile that was already painted by the copy is copied with its new color, that is the color of its source
+      painted = {}
+      for i, (lind, new_lind) in enumerate(zip(src.tolist(), dst.tolist())):
+        if lind in painted:
+          src[i], colors[i] = src[painted[lind]], colors[painted[lind]]
+        if new_lind >= 0:
+          painted[new_lind] = i
+    offboard_reads = np.flatnonzero((dst < 0) & (src >= 0))
+    if len(offboard_reads):
+      colors[offboard_reads] = HexagonsGame._read_colors(src[offboard_reads])
+      src[offboard_reads] = -1
+    for i in np.flatnonzero(dst < 0).tolist():
+      new_hexagons[i]._saved_color_id = int(colors[i])
+    pending = session._pending
+    journal_start = None
+    if session._journal.active:
+      journal_start = len(pending.journal)
+      rows = [hexagon._row for hexagon in new_hexagons]
+      columns = [hexagon._column for hexagon in new_hexagons]
+      pending.journal.record(dst, rows, columns, colors)
+    pending.add_copy(dst, src, colors, journal_start)
+
   def plot(gold_boards=None, multiple=False, file_name=None):
     '''Plot the current state of the board
 
@@ -128,9 +638,9 @@ class HexagonsGame:
       return list(map(lambda x, y: 0 if x == y else 1, board1, board2))
 
     if HexagonsGame._current_step_name is None:
-      HexagonsGame.board_states['final'] = copy(HexagonsGame.board_state)
+      HexagonsGame._history.mark('final')
     else:
-      HexagonsGame.board_states[HexagonsGame._current_step_name] = copy(HexagonsGame.board_state)
+      HexagonsGame._history.mark(HexagonsGame._current_step_name)
     boards = list(HexagonsGame.board_states.values())
     titles = list(HexagonsGame.board_states.keys())
     if not multiple:
@@ -155,6 +665,8 @@ class HexagonsGame:
           boards += [drawn_boards[i], gold_boards[i], diff(drawn_boards[i], gold_boards[i])]
           titles += [f'code generated ({drawn_titles[i]})',f'gold ({i+1})','difference']
 
+    # matplotlib is only imported when plotting, to keep the import of the engine fast
+    import src.plot_board as pb
     fig = pb.plot_boards(boards=boards,
                          fig_size=[7, 5],
                          height=HexagonsGame.height,
@@ -177,7 +689,10 @@ class _Vec:
   It is for internal use only.
   '''
 
-  # directions_to_qrs = {key: DIRECTIONS[key].index(0) for key in DIRECTIONS}
+  __slots__ = ('_cube',)
+
+  # cube -> direction name, for the six unit vectors
+  _direction_names = {cube: name for name, cube in DIRECTIONS.items()}
 
   def __init__(self, *args):
     if isinstance(args[0], str):
@@ -197,6 +712,19 @@ class _Vec:
       raise Exception(f'cube coordinates {[q, r, s]} don\'t sum up to 0')
     self._cube = (q, r, -q - r)
 
+  def _make(q, r, s):
+    '''Construct a _Vec from cube coordinates that are known to sum up to 0, skipping validation'''
+
+    vec = _Vec.__new__(_Vec)
+    vec._cube = (q, r, s)
+    return vec
+
+  def __eq__(self, other):
+    return isinstance(other, _Vec) and self._cube == other._cube
+
+  def __hash__(self):
+    return hash(self._cube)
+
   @property
   def _q(self):
     return self._cube[0]
@@ -219,49 +747,68 @@ class _Vec:
 
   def _has_direction(self):
     # q*r*s=0 means that vec is proportional to one of the six direction vecs
-    return not bool(self._q * self._r * self._s)
+    q, r, s = self._cube
+    return not bool(q * r * s)
 
   def _normalize(self):
     if self._has_direction():
-      norm = self._norm()
-      direction_cube = [x // norm for x in self._cube]
-      return _Vec(*direction_cube)
+      q, r, s = self._cube
+      norm = (abs(q) + abs(r) + abs(s)) // 2
+      return _Vec._make(q // norm, r // norm, s // norm)
     print(f'vec {self._cube} is not a direction vector')
 
   def _direction_str(self):
     # returns a string describing the direction of the vector
     if self._has_direction():
-      return list(DIRECTIONS.keys())[list(DIRECTIONS.values()).index(self._normalize()._cube)]
+      return _Vec._direction_names[self._normalize()._cube]
     print(f'vec {self._cube} is not a direction vector')
 
   def __add__(self, other):
-    new_cube = [_ for _ in [x + y for x, y in zip(self._cube, other._cube)]]
-    return _Vec(*new_cube)
+    q0, r0, s0 = self._cube
+    q1, r1, s1 = other._cube
+    return _Vec._make(q0 + q1, r0 + r1, s0 + s1)
 
   def __sub__(self, other):
-    new_cube = [_ for _ in [x - y for x, y in zip(self._cube, other._cube)]]
-    return _Vec(*new_cube)
+    q0, r0, s0 = self._cube
+    q1, r1, s1 = other._cube
+    return _Vec._make(q0 - q1, r0 - r1, s0 - s1)
 
   def _scale(self, k):
-    return _Vec(*[k * _ for _ in self._cube])
+    q, r, s = self._cube
+    return _Vec._make(k * q, k * r, k * s)
 
   def _norm(self):
-    return np.sum([np.abs(_) for _ in self._cube]) / 2
+    q, r, s = self._cube
+    return (abs(q) + abs(r) + abs(s)) / 2
 
   def _round(self):
-    int_cube = [np.round(_) for _ in self._cube]
-    diff = [abs(x - y) for x, y in zip(int_cube, self._cube)]
-    ind = np.argmax(diff)
-    int_cube[ind] = - (np.sum(int_cube)) + int_cube[ind]
-    int_cube = [int(_) for _ in int_cube]
-    return _Vec(*int_cube)
+    q, r, s = self._cube
+    int_q, int_r, int_s = int(round(q)), int(round(r)), int(round(s))
+    diff_q, diff_r, diff_s = abs(int_q - q), abs(int_r - r), abs(int_s - s)
+    # fix the coordinate with the largest rounding error, so the coordinates sum up to 0
+    if diff_q >= diff_r and diff_q >= diff_s:
+      int_q = -int_r - int_s
+    elif diff_r >= diff_s:
+      int_r = -int_q - int_s
+    else:
+      int_s = -int_q - int_r
+    return _Vec._make(int_q, int_r, int_s)
 
 
 class _Hexagon:
   '''Class _Hexagon represents a location on the board / in the plane.
   It is for internal use only.
+
+  On-board hexagons are interned: there is a single _Hexagon object for every location on a board
+  of a given size, and it should never be modified. Use _from_lind, _from_cube and _from_offset to get them.
+  Off-board hexagons are created anew each time, since they keep their own color.
   '''
 
+  __slots__ = ('_lind', '_offset', '_cube', '_saved_color_id')
+
+  # (width, height) -> (hexagons by lind, hexagons by cube)
+  _tables = {}
+
   def complete_arguments(column, row, cube):
     '''An hexagon can be defined be two different sets of coordinates:
     offset (column, row) and cube (q, r, s).
@@ -279,8 +826,9 @@ class _Hexagon:
         raise Exception(f'cube coordinates {[q, r, s]} don\'t sum up to 0')
       column = q + 1
       row = r + (q - (q % 2)) // 2 + 1
-    if 1 <= column <= HexagonsGame.width and 1 <= row <= HexagonsGame.height:
-      lind = int((row - 1) * HexagonsGame.width + (column - 1))
+    session = HexagonsGame.current_session()
+    if 1 <= column <= session.width and 1 <= row <= session.height:
+      lind = int((row - 1) * session.width + (column - 1))
     else:
       # tile is not on board, so it has no linear index
       lind = None
@@ -291,6 +839,12 @@ class _Hexagon:
     if self._lind is None:
       self._saved_color_id = 0
 
+  def __eq__(self, other):
+    return isinstance(other, _Hexagon) and self._cube == other._cube
+
+  def __hash__(self):
+    return hash(self._cube)
+
   @property
   def _q(self):
     return self._cube[0]
@@ -307,8 +861,9 @@ class _Hexagon:
   def _color_id(self):
     if self._lind is None:
       return self._saved_color_id
-    else:
-      return HexagonsGame.board_state[self._lind]
+    session = HexagonsGame.current_session()
+    session._apply_pending()
+    return int(session._board[self._lind])
 
   @property
   def _color(self):
@@ -326,15 +881,45 @@ class _Hexagon:
     print(
       f'{self.__class__.__name__} instance: column={self._column}, row={self._row}, lind={self._lind}, color={self._color_id}')
 
+  def _interned_table(width, height):
+    '''Returns the interned on-board hexagons of a board with the given size,
+    as a tuple indexed by lind and as a dictionary keyed by cube'''
+
+    if (width, height) not in _Hexagon._tables:
+      by_lind = []
+      for lind, cube in enumerate(cube_table(width, height).tolist()):
+        hexagon = _Hexagon.__new__(_Hexagon)
+        hexagon._lind, hexagon._offset, hexagon._cube = lind, (lind % width + 1, lind // width + 1), tuple(cube)
+        by_lind.append(hexagon)
+      by_lind = tuple(by_lind)
+      by_cube = {hexagon._cube: hexagon for hexagon in by_lind}
+      _Hexagon._tables[(width, height)] = (by_lind, by_cube)
+    return _Hexagon._tables[(width, height)]
+
   def _from_lind(lind):
     '''Returns a hexagon by its linear index on the board'''
 
-    if lind in range(HexagonsGame.width * HexagonsGame.height):
-      row = lind // (HexagonsGame.width) + 1
-      column = lind % HexagonsGame.width + 1
-      return _Hexagon(column=column, row=row)
+    by_lind = HexagonsGame.current_session()._hexagons_by_lind
+    if lind in range(len(by_lind)):
+      return by_lind[int(lind)]
     print(f'lind {lind} not valid')
 
+  def _from_cube(cube):
+    '''Returns a hexagon by its cube coordinates'''
+
+    hexagon = HexagonsGame.current_session()._hexagons_by_cube.get(cube)
+    if hexagon is None:
+      hexagon = _Hexagon(cube=cube)
+    return hexagon
+
+  def _from_offset(column, row):
+    '''Returns a hexagon by its offset coordinates'''
+
+    session = HexagonsGame.current_session()
+    if 1 <= column <= session.width and 1 <= row <= session.height and column % 1 == 0 and row % 1 == 0:
+      return session._hexagons_by_lind[int((row - 1) * session.width + (column - 1))]
+    return _Hexagon(column=column, row=row)
+
   def _on_board(self):
     '''Returns True iff self lies on the board'''
 
@@ -344,7 +929,9 @@ class _Hexagon:
     '''Compute the difference between self and other
     The difference is a _Vec object'''
 
-    return _Vec(*[int(_) for _ in [x - y for x, y in zip(self._cube, other._cube)]])
+    q0, r0, s0 = self._cube
+    q1, r1, s1 = other._cube
+    return _Vec._make(int(q0 - q1), int(r0 - r1), int(s0 - s1))
 
   def _shift(self, *args):
     '''Compute a new hexagon by shifting self to another location'''
@@ -353,8 +940,9 @@ class _Hexagon:
       vec = args[0]
     else:
       vec = _Vec(*args)
-    new_cube = [int(_) for _ in [x + y for x, y in zip(self._cube, vec._cube)]]
-    return _Hexagon(cube=new_cube)
+    q0, r0, s0 = self._cube
+    q1, r1, s1 = vec._cube
+    return _Hexagon._from_cube((int(q0 + q1), int(r0 + r1), int(s0 + s1)))
 
   def _copy_paste(self, vec, color=None):
     '''Copy self to another location
@@ -364,9 +952,9 @@ class _Hexagon:
     new_tile._draw(self._color_id if color is None else color)
     return new_tile
 
-  def _reflect(self, axis_line=None, column=None, axis_direction=None, hexagon_on_axis=None):
-    '''Reflect self
-    Compute the new location and draw there'''
+  def _reflection_axis(axis_line=None, column=None, axis_direction=None, hexagon_on_axis=None):
+    '''Returns the axis of a reflection as a pair (normal, pivot) of integer cube vectors:
+    the axis passes through the cube 'pivot' and is perpendicular to the vector 'normal' '''
 
     if axis_direction == 'horizontal':
       direction_vec = _Vec(2, -1, -1)
@@ -379,23 +967,24 @@ class _Hexagon:
           axis_direction = 'up'
         direction_vec = _Vec(axis_direction)
 
-    v_direction_reciprocal = np.array(
-      [direction_vec._r - direction_vec._s, direction_vec._s - direction_vec._q, direction_vec._q - direction_vec._r])
-    v_direction_reciprocal = v_direction_reciprocal / np.linalg.norm(v_direction_reciprocal)
+    normal = (direction_vec._r - direction_vec._s, direction_vec._s - direction_vec._q,
+              direction_vec._q - direction_vec._r)
     if column is not None:
       # we assume if axis_value is given it represents a column number
       column = column % (HexagonsGame.width + 1)
       axis_value = column - 1
       ind = direction_vec._cube.index(0)
-      cube = _Vec.cyclic_permutation([axis_value, -axis_value, 0], ind)
-      v_on_axis = np.array(cube)
+      pivot = tuple(_Vec.cyclic_permutation([axis_value, -axis_value, 0], ind))
     else:
-      v_on_axis = np.array(hexagon_on_axis._cube)
-    v_self = np.array(self._cube)
-    v_diff = v_self - v_on_axis
-    val_reciprocal = v_diff.dot(v_direction_reciprocal)
-    reflect_vec = _Vec(*list(-2 * val_reciprocal * v_direction_reciprocal))._round()
-    new_tile = self._shift(reflect_vec)
+      pivot = hexagon_on_axis._cube
+    return normal, pivot
+
+  def _reflect(self, axis_line=None, column=None, axis_direction=None, hexagon_on_axis=None):
+    '''Reflect self
+    Compute the new location and draw there'''
+
+    normal, pivot = _Hexagon._reflection_axis(axis_line, column, axis_direction, hexagon_on_axis)
+    new_tile = _Hexagon._from_cube(tuple(reflect_cubes(np.array([self._cube]), normal, pivot)[0].tolist()))
     new_tile._draw(self._color)
     return new_tile
 
@@ -403,36 +992,20 @@ class _Hexagon:
     '''Rotate self
     Compute the new location and draw there'''
 
-    v_self = np.array(self._cube)
-    v_center = np.array(center._cube)
-    rotvec = np.ones(3) / np.sqrt(3) * (angle / 60 * np.pi / 3)
-    R = Rotation.from_rotvec(rotvec).as_matrix()
-    v_new = np.matmul(v_self - v_center, R) + v_center
-    new_tile_vec = _Vec(*list(v_new))._round()
-    new_tile = _Hexagon(cube=new_tile_vec._cube)
+    new_tile = _Hexagon._from_cube(tuple(rotate_cubes(self._cube, center._cube, angle).tolist()))
     new_tile._draw(self._color)
     return new_tile
 
   def _draw(self, color):
     '''Paint self with the given color'''
 
-    color_id = COLORS.index(color) if isinstance(color, str) else color
-    if self._lind is not None:
-      HexagonsGame.board_state[self._lind] = color_id
-    else:
-      self._saved_color_id = color_id
-    if HexagonsGame._current_step_name is not None:
-      HexagonsGame._step_drawn_hexagons[HexagonsGame._current_step_name].append(self)
-    if HexagonsGame._current_batch_name is not None:
-      HexagonsGame._batch_draws[HexagonsGame._current_batch_name].append({'index':self._lind, 'row':self._row, 'column':self._column, 'color': color})
-
+    HexagonsGame._draw_hexagons([self], color)
     return self
 
   def _neighbor(self, direction):
     '''Return the neighbor of self in the given direction'''
 
-    if not isinstance(direction, _Vec):
-      vec = _Vec(direction)
+    vec = direction if isinstance(direction, _Vec) else _Vec(direction)
     return self._shift(vec)
 
   def _neighbors(self, criterion='all'):
@@ -440,12 +1013,129 @@ class _Hexagon:
 
     if self._lind is None:
       return []
-    return [self._shift(_Vec(*direction_cube)) for direction_cube in DIRECTIONS.values()]
+    session = HexagonsGame.current_session()
+    by_lind = session._hexagons_by_lind
+    return [by_lind[lind] if lind >= 0 else self._shift(_Vec._make(*direction_cube))
+            for lind, direction_cube in zip(session._neighbor_linds[self._lind].tolist(), DIRECTIONS.values())]
+
+
+class _TileOrder:
+  '''The order of the tiles of a shape that is derived from the order of the tiles of other shapes (see Shape).
+  Shapes keep their on-board tiles in a bitmask, so the order is only computed when the sequence of tiles is needed.
+  For internal use only
+
+  Parameters:
+  ---------------
+  compute: Callable[..., List[tuple]]
+    Returns the cubes of the tiles in order, given the lists of cubes of the operands in their order
+  operands: Shape
+    The shapes the order is derived from
+  '''
+
+  # the orders of operands that were not computed yet are computed first, which recurses.
+  # Past this depth, the orders of the operands are computed when the order is made
+  _MAX_DEPTH = 64
+
+  __slots__ = ('_compute', '_operands', '_cubes', 'depth')
+
+  def __init__(self, compute, *operands):
+    self._compute = compute
+    self._operands = operands
+    self._cubes = None
+    self.depth = 1 + max([operand._order.depth for operand in operands
+                          if operand._hexagons_cache is None and operand._order is not None], default=0)
+    if self.depth > _TileOrder._MAX_DEPTH:
+      for operand in operands:
+        operand._hexagons
+      self.depth = 1
+
+  def cubes(self):
+    '''Return the cubes of the tiles in order'''
+
+    if self._cubes is None:
+      self._cubes = self._compute(*[operand._cubes for operand in self._operands])
+      self._compute = self._operands = None
+    return self._cubes
+
+  # the set operations iterate over the python set of the cubes of the result
+
+  def union(left, right):
+    return list(set(left) | set(right))
+
+  def intersection(left, right):
+    return list(set(left) & set(right))
+
+  def difference(left, right):
+    return list(set(left).difference(set(right)))
+
+  def neighbors(cubes):
+    '''The difference between the list of the neighbors of the on-board tiles and the tiles'''
+
+    session = HexagonsGame.current_session()
+    table = neighbor_cubes(session.width, session.height)
+    return _TileOrder.difference([neighbor for cube in cubes for neighbor in table.get(cube, ())], cubes)
+
+  def outside(cubes):
+    '''The tiles outside the tiles, grown from the board's perimeter by adding the neighbors of the tiles found,
+    until no tiles are added'''
+
+    board = Shape.get_entire_board()._cubes
+    found = _TileOrder.difference(Shape.get_board_perimeter()._cubes, cubes)
+    while True:
+      added = _TileOrder.intersection(_TileOrder.difference(_TileOrder.neighbors(found), cubes), board)
+      if not added:
+        return found
+      found = _TileOrder.union(found, added)
+
+
+def _memoized_query(color_criteria=(), ordered=False):
+  '''Decorator for the queries of Shape that return a new shape.
+  The results are kept in Shape._query_cache, keyed by the query, its arguments, the tiles of the shape
+  and the board size. If the first argument of the query is one of 'color_criteria',
+  the result depends on the colors of the board, and the key also includes the board version.
+  If 'ordered' is True the result depends on the order of the tiles in the shape, and so does the key.
+  Callers get a copy of the cached result.'''
+
+  def decorator(query):
+    signature = inspect.signature(query)
+
+    @wraps(query)
+    def memoized_query(self, *args, **kwargs):
+      arguments = signature.bind(self, *args, **kwargs)
+      arguments.apply_defaults()
+      query_args = tuple(arguments.arguments.values())[1:]
+      shape_key = self._order_key if ordered else self._key
+      session = HexagonsGame.current_session()
+      key = (query.__name__, query_args, shape_key, session.width, session.height)
+      if query_args and query_args[0] in color_criteria:
+        session._apply_pending()
+        key += (session._board_version,)
+      try:
+        found, result = Shape._query_cache.lookup(key)
+      except TypeError:
+        # unhashable arguments
+        return query(self, *args, **kwargs)
+      if not found:
+        result = query(self, *args, **kwargs)
+        Shape._query_cache.store(key, result)
+      # queries return None for an unknown criterion
+      return None if result is None else result._copy()
+    return memoized_query
+  return decorator
 
 
 class Shape:
   '''Class Shape represents any set of tiles on the board,
-  including an empty set and a single tile'''
+  including an empty set and a single tile.
+  The tiles of a shape are ordered (in iteration, indexing, tiles, colors, etc.):
+  - a shape made from a list of tiles keeps the order of the list, without repetitions
+  - the results of +, * and - are in the iteration order of the python set of the cube coordinates of their tiles,
+    and queries that are defined by these operations (neighbors, boundary, get('outside'), ...) are ordered as
+    these operations order them
+  - from_linds, get_entire_board, get_color and the distance queries (within, ring) are ordered by linear index'''
+
+  # results of geometric queries, see _memoized_query
+  _query_cache = QueryCache()
 
   def __init__(self, tiles, from_linds=False, from_hexagons=False):
     '''
@@ -467,103 +1157,313 @@ class Shape:
         hexagons = tiles._hexagons
       else:
         hexagons = [tile._hexagon for tile in tiles]
+    self._set_hexagons(hexagons)
+
+  def _set_hexagons(self, hexagons):
+    '''Set the hexagons of self, removing duplicates while keeping their order
+    On-board hexagons are kept in a bitmask over their linear indices, the rest are kept in a tuple'''
+
+    linds = []
+    seen_linds = set()
     unique_hexagons = []
-    unique_cubes = []
+    offboard = []
+    offboard_cubes = set()
     for hexagon in hexagons:
-      if hexagon._cube not in unique_cubes:
-        unique_cubes.append(hexagon._cube)
+      lind = hexagon._lind
+      if lind is None:
+        if hexagon._cube not in offboard_cubes:
+          offboard_cubes.add(hexagon._cube)
+          offboard.append(hexagon)
+          unique_hexagons.append(hexagon)
+      elif lind not in seen_linds:
+        seen_linds.add(lind)
+        linds.append(lind)
         unique_hexagons.append(hexagon)
-    self._hexagons = tuple(unique_hexagons)
+    if not linds:
+      mask = 0
+    elif len(linds) == 1:
+      mask = 1 << linds[0]
+    else:
+      session = HexagonsGame.current_session()
+      mask = linds_to_mask(linds, session.width * session.height)
+    self._mask = mask
+    self._offboard = tuple(offboard)
+    self._hexagons_cache = tuple(unique_hexagons)
+    self._order = None
+    self._views = {}
     if len(unique_hexagons) == 1:
       self.__class__ = Tile
 
+  def _from_mask(mask, offboard=(), order=None):
+    '''Construct a new Shape from a bitmask of on-board tiles and a sequence of off-board hexagons
+    The hexagons are only created when they are needed, ordered by 'order' (a _TileOrder) if it is given,
+    and by linear index, followed by the off-board hexagons, otherwise. For internal use only'''
+
+    shape = Shape.__new__(Shape)
+    shape._mask = mask
+    shape._offboard = tuple(offboard)
+    shape._hexagons_cache = None
+    shape._order = order
+    shape._views = {}
+    if shape._size == 1:
+      shape.__class__ = Tile
+    return shape
+
+  def from_linds(linds):
+    '''
+    Construct a new Shape from an array of linear indices of tiles on the board.
+    This is faster than Shape(linds, from_linds=True), since no tile objects are created.
+    The tiles of the new shape are ordered by their linear index.
+
+    Parameters:
+    -----------
+    linds: np.ndarray or List[int]
+      The linear indices, duplicates are allowed
+
+    Returns:
+    --------
+    Shape
+      New Shape object
+    '''
+
+    linds = np.asarray(linds, dtype=np.int64).reshape(-1)
+    session = HexagonsGame.current_session()
+    size = session.width * session.height
+    if linds.size and (linds.min() < 0 or linds.max() >= size):
+      raise Exception(f'linds {linds[(linds < 0) | (linds >= size)].tolist()} not valid')
+    return Shape._from_mask(linds_to_mask(linds, size))
+
+  @property
+  def _hexagons(self):
+    if self._hexagons_cache is None:
+      session = HexagonsGame.current_session()
+      if self._order is not None:
+        by_cube = session._hexagons_by_cube
+        offboard = {hexagon._cube: hexagon for hexagon in self._offboard}
+        self._hexagons_cache = tuple([by_cube.get(cube) or offboard[cube] for cube in self._order.cubes()])
+      else:
+        by_lind = session._hexagons_by_lind
+        self._hexagons_cache = tuple([by_lind[lind] for lind in self._linds_array.tolist()]) + self._offboard
+    return self._hexagons_cache
+
   @property
   def _size(self):
-    return len(self._hexagons)
+    return mask_size(self._mask) + len(self._offboard)
+
+  @property
+  def _linds_array(self):
+    '''The sorted array of linear indices of the on-board tiles in the shape'''
+
+    session = HexagonsGame.current_session()
+    return mask_to_linds(self._mask, session.width * session.height)
+
+  def _view(self, name, compute, depends_on_colors=False):
+    '''Return a view of self (e.g. its list of tiles), computing it only if it is not cached.
+    Views are recomputed after the board is restarted, and views that depend on the colors
+    are also recomputed after every draw.'''
+
+    session = HexagonsGame.current_session()
+    if depends_on_colors:
+      session._apply_pending()
+      version = session._board_version
+    else:
+      version = session._board_start_version
+    cached = self._views.get(name)
+    if cached is None or cached[0] != version:
+      cached = (version, compute())
+      self._views[name] = cached
+    return cached[1]
+
+  @property
+  def _key(self):
+    '''A hashable key of the set of tiles in self'''
+
+    return self._mask, tuple(sorted(hexagon._cube for hexagon in self._offboard))
+
+  @property
+  def _order_key(self):
+    '''A hashable key of the sequence of tiles in self. Shapes whose order is derived from other shapes
+    are keyed by their _TileOrder, so that the order doesn't have to be computed'''
+
+    if self._order is None and self._hexagons_cache is not None:
+      return tuple(hexagon._cube for hexagon in self._hexagons_cache)
+    return self._key, self._order
+
+  def _copy(self):
+    '''Return a copy of self, with its own off-board hexagons, so that drawing on the copy doesn't affect self'''
+
+    fresh = {hexagon._cube: _Hexagon(cube=hexagon._cube) for hexagon in self._offboard}
+    shape = Shape._from_mask(self._mask, fresh.values(), self._order)
+    if self._hexagons_cache is not None:
+      shape._hexagons_cache = tuple(hexagon if hexagon._lind is not None else fresh[hexagon._cube]
+                                    for hexagon in self._hexagons_cache)
+    return shape
+
+  def query_cache_info():
+    '''Return the statistics of the cache of geometric queries:
+    hits, misses, maxsize and currsize (the number of cached results)'''
+
+    return Shape._query_cache.info()
+
+  @property
+  def _regions(self):
+    '''The partition of the board into the tiles outside self, inside self and in self'''
+
+    return self._view('regions', lambda: Regions(self._bits, HexagonsGame.width, HexagonsGame.height))
 
   @property
   def _linds(self):
-    return [hexagon._lind for hexagon in self._hexagons]
+    return list(self._view('linds', lambda: [hexagon._lind for hexagon in self._hexagons]))
+
+  @property
+  def _bits(self):
+    '''A boolean array over the board, True at the tiles of the shape'''
+
+    session = HexagonsGame.current_session()
+    return mask_to_bits(self._mask, session.width * session.height)
+
+  def _edge_hexagons(self, neighbor_linds):
+    '''Return the on-board hexagons of self that have off-board neighbors, and their row numbers in 'neighbor_linds',
+    the rows of the neighbors table of the on-board tiles of self'''
+
+    rows = np.flatnonzero(np.any(neighbor_linds < 0, axis=1))
+    linds = self._linds_array[rows]
+    return [HexagonsGame._hexagons_by_lind[lind] for lind in linds.tolist()], rows.tolist()
+
+  def _select(self, linds):
+    '''Return the shape of the on-board tiles of self with the given linear indices, in the order of self'''
+
+    session = HexagonsGame.current_session()
+    cubes = set(map(tuple, cube_table(session.width, session.height)[linds].tolist()))
+    return Shape._from_mask(linds_to_mask(linds, session.width * session.height),
+                            order=_TileOrder(lambda self_cubes: [cube for cube in self_cubes if cube in cubes], self))
+
+  def _neighbors_in(self, other):
+    '''Return a boolean array of shape (number of on-board tiles in self, 6).
+    Entry [i, d] is True iff the neighbor of the i-th on-board tile of self in direction d belongs to other'''
+
+    neighbor_linds = HexagonsGame._neighbor_linds[self._linds_array]
+    # lind -1 (off-board) picks the appended False
+    is_in = np.append(other._bits, False)[neighbor_linds]
+    if other._offboard:
+      other_cubes = other._offboard_cubes()
+      hexagons, rows = self._edge_hexagons(neighbor_linds)
+      for hexagon, row in zip(hexagons, rows):
+        for d, neighbor in enumerate(hexagon._neighbors()):
+          if neighbor._lind is None and neighbor._cube in other_cubes:
+            is_in[row, d] = True
+    return is_in
 
   @property
   def tiles(self):
-    return [Tile(hexagon._column, hexagon._row) for hexagon in self._hexagons]
+    return list(self._view('tiles', lambda: [Tile._from_hexagon(hexagon) for hexagon in self._hexagons]))
 
   @property
   def colors(self):
-    return [hexagon._color for hexagon in self._hexagons]
+    return list(self._view('colors', lambda: [hexagon._color for hexagon in self._hexagons], depends_on_colors=True))
+
+  @property
+  def _color_ids(self):
+    '''The list of color ids of the tiles in the shape'''
+
+    return [hexagon._color_id for hexagon in self._hexagons]
 
   @property
   def columns(self):
     '''The list of columns of the tiles in the shape'''
 
-    return [hexagon._column for hexagon in self._hexagons]
+    return list(self._view('columns', lambda: cubes_to_offsets(self._cube_array)[0].tolist()))
 
   @property
   def rows(self):
     '''The list of rows of the tiles in the shape'''
 
-    return [hexagon.row for hexagon in self._hexagons]
+    return list(self._view('rows', lambda: cubes_to_offsets(self._cube_array)[1].tolist()))
+
+  @property
+  def _cube_array(self):
+    '''An (n, 3) read-only array with the cube coordinates of the tiles in the shape, in their order'''
+
+    def compute():
+      session = HexagonsGame.current_session()
+      if self._hexagons_cache is None and self._order is None:
+        # the on-board tiles are ordered by their linear index, and are read from the board's table
+        offboard_cubes = np.array([hexagon._cube for hexagon in self._offboard], dtype=np.int64).reshape(-1, 3)
+        cubes = np.concatenate([cube_table(session.width, session.height)[self._linds_array], offboard_cubes])
+      else:
+        linds = np.array([-1 if lind is None else lind for lind in self._linds], dtype=np.int64)
+        cubes = cube_table(session.width, session.height)[linds]
+        offboard = np.flatnonzero(linds < 0)
+        if len(offboard):
+          cubes[offboard] = [self._hexagons[i]._cube for i in offboard.tolist()]
+      cubes.flags.writeable = False
+      return cubes
+    return self._view('cube_array', compute)
 
   @property
   def _cubes(self):
     '''The list of cube coordinates of the tiles in the shape'''
 
-    return [hexagon._cube for hexagon in self._hexagons]
+    return list(map(tuple, self._cube_array.tolist()))
 
   @property
   def _qs(self):
     '''The list of q-coordinates of the tiles in the shape'''
-    return [hexagon._q for hexagon in self._hexagons]
+    return self._cube_array[:, 0].tolist()
 
   @property
   def _rs(self):
     '''The list of r-coordinates of the tiles in the shape'''
-    return [hexagon._r for hexagon in self._hexagons]
+    return self._cube_array[:, 1].tolist()
 
   @property
   def _ss(self):
     '''The list of s-coordinates of the tiles in the shape'''
-    return [hexagon._s for hexagon in self._hexagons]
+    return self._cube_array[:, 2].tolist()
 
   def _show(self):
     print(f'{self.__class__.__name__} instance: size={self._size}, linds={self._linds}')
 
   def __iter__(self):
-    self.n = 0
-    return self
-
-  def __next__(self):
-    if self.n < self._size:
-      result = self.tiles[self.n]
-      self.n += 1
-      return result
-    else:
-      raise StopIteration
+    for hexagon in self._hexagons:
+      yield Tile._from_hexagon(hexagon)
 
   def __getitem__(self, item):
-    return self.tiles[item]
+    if isinstance(item, slice):
+      return [Tile._from_hexagon(hexagon) for hexagon in self._hexagons[item]]
+    return Tile._from_hexagon(self._hexagons[item])
+
+  def _offboard_cubes(self):
+    return set(hexagon._cube for hexagon in self._offboard)
 
   def __add__(self, other):
     '''Use the '+' sign to compute the union of two shapes'''
 
-    cubes = list(set(self._cubes) | set(other._cubes))
-    hexs = [_Hexagon(cube=cube) for cube in cubes]
-    return Shape(hexs, from_hexagons=True)
+    offboard = self._offboard
+    if other._offboard:
+      cubes = self._offboard_cubes()
+      offboard += tuple(hexagon for hexagon in other._offboard if hexagon._cube not in cubes)
+    return Shape._from_mask(self._mask | other._mask, [_Hexagon(cube=hexagon._cube) for hexagon in offboard],
+                            _TileOrder(_TileOrder.union, self, other))
 
   def __mul__(self, other):
     '''Use the '*' sign to compute the intersection of two shapes'''
 
-    cubes = list(set(self._cubes) & set(other._cubes))
-    hexs = [_Hexagon(cube=cube) for cube in cubes]
-    return Shape(hexs, from_hexagons=True)
+    offboard = ()
+    if self._offboard and other._offboard:
+      cubes = other._offboard_cubes()
+      offboard = [_Hexagon(cube=hexagon._cube) for hexagon in self._offboard if hexagon._cube in cubes]
+    return Shape._from_mask(self._mask & other._mask, offboard, _TileOrder(_TileOrder.intersection, self, other))
 
   def __sub__(self, other):
     '''Use the '-' sign to compute the difference between two shapes'''
 
-    cubes = list(set(self._cubes).difference(set(other._cubes)))
-    hexs = [_Hexagon(cube=cube) for cube in cubes]
-    return Shape(hexs, from_hexagons=True)
+    offboard = self._offboard
+    if offboard and other._offboard:
+      cubes = other._offboard_cubes()
+      offboard = [hexagon for hexagon in offboard if hexagon._cube not in cubes]
+    return Shape._from_mask(self._mask & ~other._mask, [_Hexagon(cube=hexagon._cube) for hexagon in offboard],
+                            _TileOrder(_TileOrder.difference, self, other))
 
   def _compute_shift_from_spacing(self, direction, spacing, reference_shape=None):
     '''Compute how much to shift a shape, to create a copy with a desired spacing from self
@@ -606,10 +1506,12 @@ class Shape:
       True of self is empty, False otherwise
     '''
 
-    return self._size == 0
+    return self._mask == 0 and not self._offboard
 
   def overlaps(self, S):
-    return not (self * S).is_empty()
+    if self._mask & S._mask:
+      return True
+    return bool(self._offboard) and bool(S._offboard) and not self._offboard_cubes().isdisjoint(S._offboard_cubes())
 
   def _reduce_to_board(self):
     return Shape([tile for tile in self if tile.on_board()])
@@ -624,8 +1526,7 @@ class Shape:
       The color
     '''
 
-    for hexagon in self._hexagons:
-      hexagon._draw(color)
+    HexagonsGame._draw_hexagons(self._hexagons, color, unique=True)
 
   def copy_paste(self, shift_direction=None, spacing=0, reference_shape=None,
                  source=None, destination=None, shift=None):
@@ -664,13 +1565,30 @@ class Shape:
       else:
         shift = self._compute_shift_from_spacing(shift_direction, spacing, reference_shape)
 
-    new_hexagons = []
-    for hexagon in self._hexagons:
-      hexagon._copy_paste(shift)
-      new_hexagons.append(hexagon._shift(shift))
+    new_hexagons = [hexagon._shift(shift) for hexagon in self._hexagons]
+    self._draw_copy(new_hexagons)
     new_shape = Shape(new_hexagons, from_hexagons=True)
     return new_shape
 
+  def _draw_copy(self, new_hexagons):
+    '''Draw a copy of self with a single draw: the i-th hexagon of self is copied to the i-th new hexagon.
+    When the copy overlaps self, the result is the same as copying the tiles one by one in order:
+    a tile that was already painted by the copy is copied with its new color'''
+
+    session = HexagonsGame.current_session()
+    if session._pending is not None:
+      HexagonsGame._copy_hexagons(self._hexagons, new_hexagons)
+      return
+    colors = self._color_ids
+    source_linds = self._linds
+    if not set(source_linds).isdisjoint(hexagon._lind for hexagon in new_hexagons if hexagon._lind is not None):
+      painted = {}
+      for i, (lind, hexagon) in enumerate(zip(source_linds, new_hexagons)):
+        colors[i] = painted.get(lind, colors[i])
+        if hexagon._lind is not None:
+          painted[hexagon._lind] = colors[i]
+    HexagonsGame._draw_hexagons(new_hexagons, np.array(colors, dtype=int), unique=True)
+
   def grid(self, shift_direction, spacing, num_copies=None):
     '''
     Draw copies of self along a grid.
@@ -728,11 +1646,11 @@ class Shape:
       New Shape object that holds the original shape and all its copies
     '''
 
-    new_hexagons = []
     hexagon_on_axis = None if tile_on_axis is None else tile_on_axis._hexagon
-    for hexagon in self._hexagons:
-      new_hexagons.append(hexagon._reflect(axis_line=axis_line, column=column, axis_direction=axis_direction,
-                                           hexagon_on_axis=hexagon_on_axis))
+    normal, pivot = _Hexagon._reflection_axis(axis_line, column, axis_direction, hexagon_on_axis)
+    new_cubes = reflect_cubes(self._cube_array, normal, pivot)
+    new_hexagons = [_Hexagon._from_cube(tuple(cube)) for cube in new_cubes.tolist()]
+    self._draw_copy(new_hexagons)
     new_shape = Shape(new_hexagons, from_hexagons=True)
     return new_shape
 
@@ -753,20 +1671,43 @@ class Shape:
       New Shape object that holds the original shape and all its copies
     '''
 
-    new_hexagons = []
-    for hexagon in self._hexagons:
-      new_hexagons.append(hexagon._rotate(center=center_tile._hexagon, angle=angle))
+    new_cubes = rotate_cubes(self._cube_array, center_tile._hexagon._cube, angle)
+    new_hexagons = [_Hexagon._from_cube(tuple(cube)) for cube in new_cubes.tolist()]
+    self._draw_copy(new_hexagons)
     new_shape = Shape(new_hexagons, from_hexagons=True)
     return new_shape
 
+  def rotations(self, center_tile):
+    '''
+    Return the six rotations of self around center_tile, by 0, 60, 120, 180, 240 and 300 degrees
+    counterclockwise. Nothing is drawn.
+
+    Parameters:
+    -----------
+    center_tile: Tile
+      The tile around which to rotate
+
+    Returns:
+    --------
+    List[Shape]
+      Six new Shape objects
+    '''
+
+    all_cubes = cube_rotations(self._cube_array, center_tile._hexagon._cube)
+    return [Shape([_Hexagon._from_cube(tuple(cube)) for cube in cubes], from_hexagons=True)
+            for cubes in all_cubes.tolist()]
+
   def recolor(self, color_map):
     '''
     re-color each tile in the shape
     color_map describes a mapping from colors to colors, e.g. {'red': 'blue', 'green': 'black'}
     '''
-    for hexagon in self._hexagons:
-      if hexagon._on_board():
-        hexagon._draw(color_map[hexagon._color])
+    hexagons = [hexagon for hexagon in self._hexagons if hexagon._on_board()]
+    color_ids = HexagonsGame._read_colors([hexagon._lind for hexagon in hexagons])
+    id_map = np.arange(len(COLORS), dtype=color_ids.dtype)
+    for color_id in np.unique(color_ids):
+      id_map[color_id] = COLORS.index(color_map[COLORS[color_id]])
+    HexagonsGame._draw_hexagons(hexagons, id_map[color_ids], unique=True)
     return self
 
   def _shift(self, V):
@@ -778,35 +1719,43 @@ class Shape:
   def get_entire_board():
     '''Return a Shape object containing all the tiles on the board'''
 
-    tiles = []
-    for row in range(1, HexagonsGame.height + 1):
-      for column in range(1, HexagonsGame.width + 1):
-        tiles.append(Tile(column, row))
-    return Shape(tiles)
+    return Shape._from_mask((1 << (HexagonsGame.width * HexagonsGame.height)) - 1)
 
   def get_board_perimeter():
     '''Return a Shape object containing all the tiles on the board's perimeter'''
 
-    B = Shape.get_entire_board()
-
-    def tile_on_perimeter(tile):
-      return tile.column in [1, HexagonsGame.width] or tile.row in [1, HexagonsGame.height]
-
-    return Shape([tile for tile in B if tile_on_perimeter(tile)])
+    linds = np.arange(HexagonsGame.width * HexagonsGame.height)
+    columns = linds % HexagonsGame.width + 1
+    rows = linds // HexagonsGame.width + 1
+    on_perimeter = (columns == 1) | (columns == HexagonsGame.width) | (rows == 1) | (rows == HexagonsGame.height)
+    return Shape.from_linds(linds[on_perimeter])
 
   def get_color(color):
     '''Return a Shape object containing all the tiles painted in the given color
     If color is 'any' is will return all the tiles that are not white'''
 
+    key = ('get_color', color, HexagonsGame._board_version)
+    found, shape = Shape._query_cache.lookup(key)
+    if not found:
+      shape = Shape._get_color(color)
+      Shape._query_cache.store(key, shape)
+    return shape._copy()
+
+  def _get_color(color):
+    '''Computes get_color, without caching'''
+
     if color in ['all', 'any']:
-      return Shape([tile for tile in Shape.get_entire_board().tiles if tile.color != 'white'])
-    return Shape([tile for tile in Shape.get_entire_board().tiles if tile.color == color])
+      return Shape.from_linds(np.flatnonzero(HexagonsGame._board != COLORS.index('white')))
+    if color not in COLORS:
+      return Shape([])
+    return Shape.from_linds(np.flatnonzero(HexagonsGame._board == COLORS.index(color)))
 
   def get_column(column):
     '''Return a Shape object containing all the tiles in the given column'''
 
     return Shape([Tile(column, row) for row in range(1, HexagonsGame.height + 1)])
 
+  @_memoized_query(ordered=True)
   def get(self, criterion):
     '''
     Return a new shape according to some geometrical relation with self, described by ‘criterion’
@@ -819,15 +1768,8 @@ class Shape:
     '''
 
     if criterion == 'outside':
-      S_ext = Shape.get_board_perimeter() - self
-      while True:
-        S_ext_neighbors_not_in_self = (S_ext.neighbors('all') - self) * Shape.get_entire_board()
-        # stop if S_ext didn't grow in the last iteration
-        if S_ext_neighbors_not_in_self._size == 0:
-          break
-        else:
-          S_ext += S_ext_neighbors_not_in_self
-      return S_ext
+      # the flood fill finds the outside tiles, _TileOrder.outside orders them
+      return Shape._from_mask(bits_to_mask(self._regions.outside), order=_TileOrder(_TileOrder.outside, self))
 
     if criterion == 'inside':
       return (Shape.get_entire_board() - self) - self.get('outside')
@@ -837,26 +1779,14 @@ class Shape:
     if criterion == 'below':
       criterion = 'down'
     if criterion in DIRECTIONS:
-      direction = criterion
-      direction_cube = DIRECTIONS[direction]
-      direction_ind = direction_cube.index(0)
-      next_ind = (direction_ind + 1) % 3
-      next_grows = (direction_cube[next_ind] == 1)
-      shape_lines = [cube[direction_ind] for cube in self._cubes]
-      hexagons = []
-      entire_board_hexagons = Shape.get_entire_board()._hexagons
-      for val in np.unique(shape_lines):
-        hexagons_with_val = [hexagon for hexagon in self._hexagons if hexagon._cube[direction_ind] == val]
-        if next_grows:
-          max_val = np.max([_._cube[next_ind] for _ in hexagons_with_val])
-          hexagons += [hex for hex in entire_board_hexagons if
-                       hex._cube[direction_ind] == val and hex._cube[next_ind] > max_val]
-        else:
-          min_val = np.min([_._cube[next_ind] for _ in hexagons_with_val])
-          hexagons += [hex for hex in entire_board_hexagons if
-                       hex._cube[direction_ind] == val and hex._cube[next_ind] < min_val]
-
-      return Shape(hexagons, from_hexagons=True)
+      axis, grows, values, positions = self._line_extremes(criterion)
+      bounds = self._cube_array[positions, (axis + 1) % 3]
+      linds = lines_beyond(HexagonsGame.width, HexagonsGame.height, axis, values, bounds, grows)
+      # the tiles are listed line by line, and by linear index on each line
+      cubes = cube_table(HexagonsGame.width, HexagonsGame.height)[linds]
+      cubes = cubes[np.lexsort((linds, cubes[:, axis]))]
+      return Shape._from_mask(linds_to_mask(linds, HexagonsGame.width * HexagonsGame.height),
+                              order=_TileOrder(lambda: list(map(tuple, cubes.tolist()))))
 
     if criterion == 'top':
       return self._max('up')
@@ -865,26 +1795,20 @@ class Shape:
       return self._max('down')
 
     if criterion == 'corners':
+      # a corner has exactly two neighbors in the outer boundary, which are not on opposite sides of it
       ext = self.boundary('outer')
-      corners = []
-      for hexagon in ext._hexagons:
-        neighbors = (Shape(hexagon._neighbors(), from_hexagons=True) * ext)._hexagons
-        if len(neighbors) == 2:
-          v0 = hexagon - neighbors[0]
-          v1 = hexagon - neighbors[1]
-          if (v0 + v1)._norm() > 0.0001:
-            corners.append(hexagon)
-      return Shape(corners, from_hexagons=True)
+      is_in = ext._neighbors_in(ext)
+      # DIRECTIONS come in pairs of opposite directions
+      opposite_pair = is_in[:, 0::2] & is_in[:, 1::2]
+      is_corner = (is_in.sum(axis=1) == 2) & ~np.any(opposite_pair, axis=1)
+      return ext._select(ext._linds_array[is_corner])
 
     if criterion == 'endpoints':
       ext = self.boundary('outer')
-      ends = []
-      for hexagon in ext._hexagons:
-        neighbors = (Shape(hexagon._neighbors(), from_hexagons=True) * ext)._hexagons
-        if len(neighbors) == 1:
-          ends.append(hexagon)
-      return Shape(ends, from_hexagons=True)
+      is_end = ext._neighbors_in(ext).sum(axis=1) == 1
+      return ext._select(ext._linds_array[is_end])
 
+  @_memoized_query(ordered=True)
   def boundary(self, criterion='all'):
     '''Return the boundary of the shape. These are tiles that are part of the shape and touch
     tiles that are not part of the shape.
@@ -911,39 +1835,40 @@ class Shape:
 
     return self.boundary('outer') + self.boundary('inner')
 
+  def _line_extremes(self, direction):
+    '''Group the tiles of self by the lines parallel to the given direction.
+    Returns the axis of the cube coordinate that is constant on these lines, whether the direction
+    grows along the next coordinate, the sorted line values and for each line the position in self._hexagons
+    of the tile of self that is furthest in the direction'''
+
+    direction_cube = DIRECTIONS[direction]
+    axis = direction_cube.index(0)
+    grows = direction_cube[(axis + 1) % 3] == 1
+    cubes = self._cube_array
+    values, positions = line_extremes(cubes[:, axis], cubes[:, (axis + 1) % 3], grows)
+    return axis, grows, values, positions
+
+  @_memoized_query()
   def _max(self, direction):
     '''Returns a Shape object containing the tiles of the shape which are maximal in the given direction
     For internal use only'''
 
-    direction_cube = DIRECTIONS[direction]
-    direction_ind = direction_cube.index(0)
-    next_ind = (direction_ind + 1) % 3
-    next_grows = (direction_cube[next_ind] == 1)
-    shape_lines = [cube[direction_ind] for cube in self._cubes]
-    hexagons = []
-    for val in np.unique(shape_lines):
-      hexagons_with_val = [hexagon for hexagon in self._hexagons if hexagon._cube[direction_ind] == val]
-      if next_grows:
-        hexagons.append(hexagons_with_val[np.argmax([_._cube[next_ind] for _ in hexagons_with_val])])
-      else:
-        hexagons.append(hexagons_with_val[np.argmin([_._cube[next_ind] for _ in hexagons_with_val])])
-    return Shape(hexagons, from_hexagons=True)
+    positions = self._line_extremes(direction)[3]
+    hexagons = self._hexagons
+    return Shape([hexagons[i] for i in positions.tolist()], from_hexagons=True)
 
+  @_memoized_query()
   def extreme(self, direction):
     '''Returns a Shape object containing the extreme tiles of self in the given direction'''
 
-    def height(cube, dcube):
-      return cube[0] * dcube[0] + cube[1] * dcube[1] + cube[2] * dcube[2]
-
-    direction_cube = DIRECTIONS[direction]
     hexagons = self._max(direction)._hexagons
-    heights = [height(hexagon._cube, direction_cube) for hexagon in hexagons]
-    vhexagons = []
-    for i in range(len(heights)):
-      if (i == 0 or heights[i] > heights[i - 1]) and (i == len(heights) - 1 or heights[i] > heights[i + 1]):
-        vhexagons.append(hexagons[i])
-    return Shape(vhexagons, from_hexagons=True)
+    heights = np.array([hexagon._cube for hexagon in hexagons]).reshape(-1, 3) @ np.array(DIRECTIONS[direction])
+    # tiles higher than the tiles on the neighboring lines
+    padded = np.concatenate([[-np.inf], heights, [-np.inf]])
+    is_extreme = (heights > padded[:-2]) & (heights > padded[2:])
+    return Shape([hexagons[i] for i in np.flatnonzero(is_extreme).tolist()], from_hexagons=True)
 
+  @_memoized_query(ordered=True)
   def edge(self, direction):
     '''Return the edge tiles of self according to some direction'''
 
@@ -953,19 +1878,22 @@ class Shape:
       return self._max('down')
 
     if direction in ['right', 'left']:
-      shape_lines = self._qs
+      axis = 0
     elif direction in ['down_left', 'up_right']:
-      shape_lines = self._rs
+      axis = 1
     elif direction in ['up_left', 'down_right']:
-      shape_lines = self._ss
+      axis = 2
 
+    shape_lines = self._cube_array[:, axis]
     if direction in ['down_left', 'up_left', 'right']:
       extreme_line = np.amax(shape_lines)
     else:
       extreme_line = np.amin(shape_lines)
 
-    return Shape([tile for tile, line in zip(self.tiles, shape_lines) if line == extreme_line])
+    hexagons = self._hexagons
+    return Shape([hexagons[i] for i in np.flatnonzero(shape_lines == extreme_line).tolist()], from_hexagons=True)
 
+  @_memoized_query(color_criteria=('white',), ordered=True)
   def neighbors(self, criterion='all'):
     '''Return a Shape object containing the neighbors of self, or a subset of them,
     accortidng to some criterion.
@@ -979,8 +1907,16 @@ class Shape:
     '''
 
     if criterion == 'all':
-      return Shape([neighbor_hexagon for hexagon in self._hexagons for neighbor_hexagon in hexagon._neighbors()],
-                   from_hexagons=True) - self
+      neighbor_linds = HexagonsGame._neighbor_linds[self._linds_array]
+      mask = linds_to_mask(neighbor_linds[neighbor_linds >= 0], HexagonsGame.width * HexagonsGame.height)
+      offboard = {}
+      for hexagon in self._edge_hexagons(neighbor_linds)[0]:
+        for neighbor in hexagon._neighbors():
+          if neighbor._lind is None:
+            offboard.setdefault(neighbor._cube, neighbor)
+      neighbors = Shape._from_mask(mask, offboard.values()) - self
+      neighbors._order = _TileOrder(_TileOrder.neighbors, self)
+      return neighbors
     if criterion in ['right', 'left']:
       edge = self.edge(criterion)
       down = Shape([_.neighbor('down_' + criterion) for _ in edge])
@@ -995,7 +1931,7 @@ class Shape:
     if criterion == 'inside':
       return self.neighbors('all') * self.get('inside')
     if criterion == 'white':
-      return Shape([tile for tile in Shape.get_entire_board() if tile.color == 'white']) * self.neighbors()
+      return Shape.get_color('white') * self.neighbors()
     if criterion in DIRECTIONS:
       return self.get(criterion) * self.neighbors()
 
@@ -1004,6 +1940,49 @@ class Shape:
 
     return Shape([tile.neighbor(direction) for tile in self.tiles]) - self
 
+  def _distances_to_self(self):
+    '''Return an (N,) int array with the hex distance of every tile on the board to the nearest on-board tile of self
+    (-1 if there is none). Off-board tiles have no neighbors, so they are not sources of distance'''
+
+    return distances_to_set(self._linds_array, HexagonsGame.width, HexagonsGame.height)
+
+  @_memoized_query()
+  def within(self, k):
+    '''Return the tiles of the board at hex distance at most k from self (self's tiles on the board included).
+    Equivalent to adding its neighbors to self k times, restricted to the board'''
+
+    distances = self._distances_to_self()
+    return Shape._from_mask(bits_to_mask((distances >= 0) & (distances <= k)))
+
+  @_memoized_query()
+  def ring(self, k):
+    '''Return the tiles of the board at hex distance exactly k from self'''
+
+    distances = self._distances_to_self()
+    return Shape._from_mask(bits_to_mask(distances == k))
+
+  def distance_field(self):
+    '''Return a read-only (N,) int array, indexed by linear index, with the number of steps from every tile
+    of the board to the nearest on-board tile of self (0 on self, -1 everywhere if self has no tiles on the board).
+    These are the distances that within and ring select from'''
+
+    field = self._distances_to_self()
+    field.flags.writeable = False
+    return field
+
+  def level_set(self, k):
+    '''Return the tiles of the board at exactly k steps from self (see distance_field).
+    E.g. the level sets k = 2, 4, 6 of a shape are concentric outlines around it.
+    On the board the number of steps is the hex distance, so this is ring(k)'''
+
+    return self.ring(k)
+
+  def distances(self, other):
+    '''Return the (len(self), len(other)) int array of the hex distances between the tiles of self and of other,
+    in the order of their tiles'''
+
+    return cube_distances(self._cube_array, other._cube_array)
+
   def polygon(vertices, *args):
     '''Return a polygon with the given vertices'''
 
@@ -1040,11 +2019,12 @@ class Shape:
 
     return polygon
 
+  @_memoized_query()
   def center(self):
     '''Rturns the center of mass of self.
     If the center of mass is not an exact tile location, it will round it to be a tile location'''
 
-    hexagon_mean = _Hexagon(cube=self._center_of_mass()._round()._cube)
+    hexagon_mean = _Hexagon._from_cube(self._center_of_mass()._round()._cube)
     return Tile(*hexagon_mean._offset)
 
 
@@ -1075,9 +2055,10 @@ class Tile(Shape):
       The row on which this tile is located. Starts from 1 and counted from top to bottom.
       A negative value represents counting from bottom to top. E.g., the first row from the bottom is -1.
     '''
-    column = column % (HexagonsGame.width + 1)
-    row = row % (HexagonsGame.height + 1)
-    self._hexagons = [_Hexagon(column=column, row=row, cube=None)]
+    session = HexagonsGame.current_session()
+    column = column % (session.width + 1)
+    row = row % (session.height + 1)
+    self._set_hexagons([_Hexagon._from_offset(column, row)])
 
   @property
   def _hexagon(self):
@@ -1110,9 +2091,30 @@ class Tile(Shape):
   def _to_tile(_hexagon):
     return Shape([_hexagon], from_hexagons=True)
 
+  def _from_hexagon(hexagon):
+    '''Return the tile at the location of the given hexagon. For internal use only'''
+
+    if hexagon._lind is None:
+      return Tile(hexagon._column, hexagon._row)
+    tile = Tile.__new__(Tile)
+    tile._mask = 1 << hexagon._lind
+    tile._offboard = ()
+    tile._hexagons_cache = (hexagon,)
+    tile._order = None
+    tile._views = {}
+    return tile
+
   def on_board(self):
     return self._lind is not None
 
+  def distance_to(self, other):
+    '''Return the hex distance from self to the nearest tile of other (a Tile or a Shape).
+    Tiles of other that are not on the board count too. Returns None if other has no tiles'''
+
+    if other.is_empty():
+      return None
+    return int(self.distances(other).min())
+
   def neighbor(self, direction):
     '''
     Return the neighbor of self in the given direction.
@@ -1192,7 +2194,7 @@ class Line(Shape):
     count = 0
     hexagons = []
     hexagon = shexagon
-    while count < length and hexagon._on_board() and hexagon._cube not in end_tiles._cubes:
+    while count < length and hexagon._on_board() and not end_tiles._mask >> hexagon._lind & 1:
       hexagons.append(hexagon)
       hexagon = hexagon._shift(direction_vec)
       count += 1
@@ -0,0 +1,465 @@
+'''history
+Records of what was drawn on the board.
+
+BoardHistory is a delta-encoded history of the board: every draw appends the tiles whose color it changed,
+as (lind, old color id, new color id). Every 'checkpoint_interval' changes, a full copy of the board is kept,
+so the board after any draw can be rebuilt from the closest checkpoint in time proportional to the changes
+in between.
+
+DrawJournal is a columnar journal of the tiles drawn during recorded steps and batches.
+
+UndoBuffer keeps references to the last draws in the history, so that they can be undone and redone.
+
+DrawEvent describes the changes of one draw, for the observers of a game session.
+
+PendingDraws buffers the draws made in a batch, until they are applied to the board as a single draw.
+'''
+
+from bisect import bisect_right
+from collections import deque, namedtuple
+from collections.abc import Mapping, Sequence
+import numpy as np
+
+from constants.constants import COLORS
+from src.board import BOARD_DTYPE
+
+class GrowableArray:
+  '''A 1-d numpy array that grows by doubling, for amortized O(1) appends
+
+  Parameters:
+  ---------------
+  dtype: numpy dtype
+    The type of the elements
+  '''
+
+  def __init__(self, dtype, capacity=64):
+    self._data = np.zeros(capacity, dtype=dtype)
+    self._size = 0
+
+  def __len__(self):
+    return self._size
+
+  def _grow(self, size):
+    '''Make room for 'size' elements'''
+
+    if size > len(self._data):
+      data = np.zeros(max(size, 2 * len(self._data)), dtype=self._data.dtype)
+      data[:self._size] = self._data[:self._size]
+      self._data = data
+
+  def extend(self, values):
+    end = self._size + len(values)
+    self._grow(end)
+    self._data[self._size:end] = values
+    self._size = end
+
+  def fill(self, value, n):
+    '''Append 'value' n times'''
+
+    end = self._size + n
+    self._grow(end)
+    self._data[self._size:end] = value
+    self._size = end
+
+  def append(self, value):
+    self._grow(self._size + 1)
+    self._data[self._size] = value
+    self._size += 1
+
+  def truncate(self, size):
+    '''Drop the elements from index 'size' on'''
+
+    self._size = min(self._size, size)
+
+  @property
+  def values(self):
+    '''A view of the elements (it is invalidated by later appends)'''
+
+    return self._data[:self._size]
+
+def _last_values(linds, values):
+  '''Return the unique linds and, for each of them, the value that comes last'''
+
+  unique_linds, positions = np.unique(linds[::-1], return_index=True)
+  return unique_linds, values[::-1][positions]
+
+class BoardHistory:
+  '''The history of the board, from a blank board, as a journal of color changes grouped by draws
+
+  Parameters:
+  ---------------
+  size: int
+    The number of tiles on the board
+  checkpoint_interval: int
+    The number of changes between full copies of the board
+  '''
+
+  def __init__(self, size, checkpoint_interval=4096):
+    self.size = size
+    self.checkpoint_interval = checkpoint_interval
+    self._linds = GrowableArray(np.int32)
+    self._old = GrowableArray(BOARD_DTYPE)
+    self._new = GrowableArray(BOARD_DTYPE)
+    # _draw_ends[d] is the number of changes made by the first d draws
+    self._draw_ends = GrowableArray(np.int64)
+    self._draw_ends.append(0)
+    # checkpoints are kept in increasing order of position: (position in the journal, board)
+    self._checkpoint_positions = [0]
+    self._checkpoint_boards = [np.zeros(size, dtype=BOARD_DTYPE)]
+    # step name -> number of draws
+    self.marks = {}
+
+  @property
+  def num_draws(self):
+    return len(self._draw_ends) - 1
+
+  def record(self, linds, old, new, board, unique=False):
+    '''Record a draw that wrote the colors 'new' to the tiles 'linds' of 'board' (arrays),
+    where 'old' holds their colors before the draw. Unless 'unique' is True, a tile may be written more than once:
+    its first old color and its color on the board are kept.
+    Returns the changes, as a triple of arrays (linds, old colors, new colors)'''
+
+    if not unique and len(linds) > 1:
+      unique_linds, first = np.unique(linds, return_index=True)
+      if len(unique_linds) < len(linds):
+        linds, old, new = unique_linds, old[first], board[unique_linds]
+    changed = new != old
+    if not changed.all():
+      linds, old, new = linds[changed], old[changed], new[changed]
+    if len(linds):
+      self._linds.extend(linds)
+      self._old.extend(old)
+      self._new.extend(new)
+    self._end_draw(board)
+    return linds, old, new
+
+  def record_tile(self, lind, old, new, board):
+    '''Record a draw that wrote the color 'new' to the single tile 'lind' of 'board', whose color was 'old' (ints)'''
+
+    if old != new:
+      self._linds.append(lind)
+      self._old.append(old)
+      self._new.append(new)
+    self._end_draw(board)
+
+  def _end_draw(self, board):
+    position = len(self._linds)
+    self._draw_ends.append(position)
+    if position - self._checkpoint_positions[-1] >= self.checkpoint_interval:
+      self._checkpoint_positions.append(position)
+      self._checkpoint_boards.append(board.copy())
+
+  def draw_changes(self, draw):
+    '''Return the changes made by the draw number 'draw' (from 1 to num_draws),
+    as a triple of arrays (linds, old colors, new colors)'''
+
+    start, end = self._position(draw - 1), self._position(draw)
+    return (self._linds.values[start:end].astype(np.int64), self._old.values[start:end].copy(),
+            self._new.values[start:end].copy())
+
+  def mark(self, name):
+    '''Mark the current draw under the given name'''
+
+    self.marks[name] = self.num_draws
+
+  def _position(self, draw):
+    if not 0 <= draw <= self.num_draws:
+      raise Exception(f'draw {draw} not valid, there are {self.num_draws} draws')
+    return int(self._draw_ends.values[draw])
+
+  def board_at(self, draw):
+    '''Return the board after the first 'draw' draws, as an array of color ids'''
+
+    position = self._position(draw)
+    i = bisect_right(self._checkpoint_positions, position) - 1
+    board = self._checkpoint_boards[i].copy()
+    start = self._checkpoint_positions[i]
+    if position > start:
+      linds, colors = _last_values(self._linds.values[start:position], self._new.values[start:position])
+      board[linds] = colors
+    return board
+
+  def diff(self, draw1, draw2):
+    '''Return the tiles whose color differs between the board after 'draw1' draws and after 'draw2' draws,
+    as a triple of arrays (linds, colors after draw1, colors after draw2)'''
+
+    position1, position2 = self._position(draw1), self._position(draw2)
+    start, end = min(position1, position2), max(position1, position2)
+    linds = self._linds.values[start:end]
+    # the color before the changes is the old color of the first change of each tile, and after them the new color
+    unique_linds, first = np.unique(linds, return_index=True)
+    before = self._old.values[start:end][first]
+    after = _last_values(linds, self._new.values[start:end])[1]
+    changed = before != after
+    if position1 > position2:
+      before, after = after, before
+    return unique_linds[changed], before[changed], after[changed]
+
+class StepBoardsView(Mapping):
+  '''A read-only mapping from step names to the board state (list of color ids) at the end of the step,
+  with the interface of the dictionary that used to hold the boards of the steps'''
+
+  def __init__(self, history):
+    self._history = history
+
+  def __getitem__(self, name):
+    return self._history.board_at(self._history.marks[name]).tolist()
+
+  def __iter__(self):
+    return iter(self._history.marks)
+
+  def __len__(self):
+    return len(self._history.marks)
+
+  def __repr__(self):
+    return repr(dict(self))
+
+class DrawJournal:
+  '''A journal of the tiles drawn during recorded steps and batches, with one entry per drawn tile.
+  The entries are kept in growable arrays (columns): the tile's lind (-1 if the tile is not on the board),
+  row, column and color id, and the ids of the step and the batch during which it was drawn (-1 if none).
+
+  Steps and batches only start and never end, so the step ids and the batch ids are non-decreasing
+  along the journal, and the entries of every step or batch are consecutive.
+  '''
+
+  def __init__(self):
+    self.linds = GrowableArray(np.int32)
+    self.rows = GrowableArray(np.int32)
+    self.columns = GrowableArray(np.int32)
+    self.colors = GrowableArray(BOARD_DTYPE)
+    self.step_ids = GrowableArray(np.int32)
+    self.batch_ids = GrowableArray(np.int32)
+    # name -> id of the last step / batch started with that name
+    self.steps = {}
+    self.batches = {}
+    self.current_step = -1
+    self.current_batch = -1
+
+  def __len__(self):
+    return len(self.linds)
+
+  @property
+  def active(self):
+    '''True iff draws are recorded'''
+
+    return self.current_step >= 0 or self.current_batch >= 0
+
+  def start_step(self, name):
+    self.current_step += 1
+    self.steps[name] = self.current_step
+
+  def start_batch(self, name):
+    self.current_batch += 1
+    self.batches[name] = self.current_batch
+
+  def record(self, linds, rows, columns, colors):
+    '''Record the drawn tiles, given as arrays of their linds, rows, columns and color ids.
+    'colors' can also be a single color id'''
+
+    n = len(linds)
+    self.linds.extend(linds)
+    self.rows.extend(rows)
+    self.columns.extend(columns)
+    if isinstance(colors, np.ndarray):
+      self.colors.extend(colors)
+    else:
+      self.colors.fill(colors, n)
+    self.step_ids.fill(self.current_step, n)
+    self.batch_ids.fill(self.current_batch, n)
+
+  def _columns(self):
+    return self.linds, self.rows, self.columns, self.colors, self.step_ids, self.batch_ids
+
+  def pop_entries(self, start):
+    '''Remove the entries from index 'start' on, and return them as a tuple of columns'''
+
+    entries = tuple(column.values[start:].copy() for column in self._columns())
+    for column in self._columns():
+      column.truncate(start)
+    return entries
+
+  def push_entries(self, entries):
+    '''Append entries returned by pop_entries'''
+
+    for column, values in zip(self._columns(), entries):
+      column.extend(values)
+
+  def entries(self, ids, id):
+    '''Return the slice of the entries with the given id, in the column 'ids' (step_ids or batch_ids)'''
+
+    start, end = np.searchsorted(ids.values, [id, id + 1])
+    return slice(int(start), int(end))
+
+class DrawRecordView(Sequence):
+  '''A read-only view of the entries of one batch in a DrawJournal, with the interface of the list of dictionaries
+  that used to hold them: each draw is described by {'index', 'row', 'column', 'color'}, where 'index' is None
+  for tiles that are not on the board. The columns are also available as arrays'''
+
+  def __init__(self, journal, batch_id):
+    self._journal = journal
+    self._batch_id = batch_id
+
+  def _column(self, column):
+    return column.values[self._journal.entries(self._journal.batch_ids, self._batch_id)]
+
+  @property
+  def linds(self):
+    return self._column(self._journal.linds)
+
+  @property
+  def rows(self):
+    return self._column(self._journal.rows)
+
+  @property
+  def columns(self):
+    return self._column(self._journal.columns)
+
+  @property
+  def colors(self):
+    return self._column(self._journal.colors)
+
+  def __len__(self):
+    entries = self._journal.entries(self._journal.batch_ids, self._batch_id)
+    return entries.stop - entries.start
+
+  def __getitem__(self, item):
+    entries = range(len(self._journal))[self._journal.entries(self._journal.batch_ids, self._batch_id)][item]
+    if isinstance(entries, range):
+      return [self._entry(i) for i in entries]
+    return self._entry(entries)
+
+  def _entry(self, i):
+    lind = int(self._journal.linds.values[i])
+    return {'index': None if lind < 0 else lind, 'row': int(self._journal.rows.values[i]),
+            'column': int(self._journal.columns.values[i]), 'color': COLORS[self._journal.colors.values[i]]}
+
+  def __eq__(self, other):
+    if isinstance(other, Sequence):
+      return list(self) == list(other)
+    return NotImplemented
+
+  def __repr__(self):
+    return repr(list(self))
+
+# an operation of PendingDraws: tile dst[i] gets the color of tile src[i] before the operation,
+# or colors[i] where src is None or src[i] is -1. journal_start is the position of the operation's entries
+# in the journal of PendingDraws when their colors are only known when the operation is applied, and None otherwise
+_Operation = namedtuple('_Operation', ['dst', 'src', 'colors', 'journal_start'])
+
+class PendingDraws:
+  '''The draws made in a batch or in lazy mode that were not applied to the board yet, as a list of operations.
+  Consecutive draws of given colors are fused into a single operation as they are added, and copies are kept
+  as operations that read the board when they are applied. The drawn tiles are kept in a DrawJournal
+  (whose step and batch ids are not used)
+
+  Parameters:
+  ---------------
+  size: int
+    The number of tiles on the board
+  '''
+
+  def __init__(self, size):
+    self.num_draws = 0
+    self.journal = DrawJournal()
+    # the tiles written by the operations
+    self.written = np.zeros(size, dtype=bool)
+    self._operations = []
+    # the draws of given colors since the last copy
+    self._fill_linds = GrowableArray(np.int64)
+    self._fill_colors = GrowableArray(BOARD_DTYPE)
+
+  def add(self, linds, colors):
+    '''Add a draw of the given linds, with a color id per lind or a single color id'''
+
+    self.num_draws += 1
+    self._fill_linds.extend(linds)
+    if isinstance(colors, np.ndarray):
+      self._fill_colors.extend(colors)
+    else:
+      self._fill_colors.fill(colors, len(linds))
+    self.written[linds] = True
+
+  def add_copy(self, dst, src, colors, journal_start=None):
+    '''Add a draw of the tiles 'dst' (an array of linds, -1 for tiles that are not on the board),
+    where tile dst[i] gets the color of tile src[i] before the draw, or colors[i] where src[i] is -1'''
+
+    self.num_draws += 1
+    self._close_fill()
+    self._operations.append(_Operation(dst, src, colors, journal_start))
+    self.written[dst[dst >= 0]] = True
+
+  def _close_fill(self):
+    if len(self._fill_linds):
+      self._operations.append(_Operation(self._fill_linds.values.copy(), None, self._fill_colors.values.copy(), None))
+      self._fill_linds.truncate(0)
+      self._fill_colors.truncate(0)
+
+  def apply(self, board):
+    '''Apply the operations to 'board' (an array), and fill in the colors of the copied tiles in the journal.
+    Writes that are overwritten before they are read are skipped.
+    Returns the written linds (sorted, without repetitions) and their colors before the operations'''
+
+    self._close_fill()
+    # going backwards, a tile is covered if it is written later, and not read in between
+    covered = np.zeros(len(board), dtype=bool)
+    live = []
+    for operation in reversed(self._operations):
+      keep = operation.dst >= 0
+      keep[keep] = ~covered[operation.dst[keep]]
+      live.append(keep)
+      covered[operation.dst[keep]] = True
+      if operation.src is not None:
+        covered[operation.src[operation.src >= 0]] = False
+    live.reverse()
+    written = np.unique(np.concatenate([np.zeros(0, dtype=np.int64)] +
+                                       [operation.dst[keep] for operation, keep in zip(self._operations, live)]))
+    old = board[written]
+    for operation, keep in zip(self._operations, live):
+      colors = operation.colors
+      if operation.journal_start is None and not keep.any():
+        continue
+      if operation.src is not None:
+        reads = operation.src >= 0
+        colors = colors.copy()
+        colors[reads] = board[operation.src[reads]]
+        if operation.journal_start is not None:
+          self.journal.colors.values[operation.journal_start:operation.journal_start + len(colors)] = colors
+      board[operation.dst[keep]] = colors[keep]
+    return written, old
+
+# the changes of a draw, sent to the observers of a game session: arrays of the changed linds,
+# their new and old color ids, and the name of the step during which the draw was made (None if no step was recorded)
+DrawEvent = namedtuple('DrawEvent', ['linds', 'colors', 'old_colors', 'step_name'])
+
+# a draw that can be undone: its number in the board history (see BoardHistory.draw_changes),
+# the length of the journal before the draw and the step during which it was made
+UndoEntry = namedtuple('UndoEntry', ['draw', 'journal_start', 'step_id'])
+
+class UndoBuffer:
+  '''The draws that can be undone (the last 'limit' draws) and the draws that can be redone.
+  Making a new draw drops the draws that can be redone.
+  The entries only refer to draws in the BoardHistory, which keeps every change since the board was started
+  (for board_states), so the limit bounds the number of draws that can be undone, not the memory of the history
+
+  Parameters:
+  ---------------
+  limit: int
+    The maximal number of draws that can be undone
+  '''
+
+  def __init__(self, limit=1000):
+    self.done = deque(maxlen=limit)
+    # pairs (UndoEntry, the journal entries of the draw)
+    self.undone = []
+
+  @property
+  def limit(self):
+    return self.done.maxlen
+
+  def set_limit(self, limit):
+    self.done = deque(self.done, maxlen=limit)
+
+  def push(self, entry):
+    self.done.append(entry)
+    self.undone.clear()
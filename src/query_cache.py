@@ -0,0 +1,55 @@
+'''query_cache
+A bounded LRU cache for the results of queries on shapes, with hit/miss statistics.
+The cache may be shared by game sessions running in several threads, so all operations hold a lock.
+'''
+
+from collections import OrderedDict, namedtuple
+from threading import Lock
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+class QueryCache:
+  '''A least-recently-used cache
+
+  Parameters:
+  ---------------
+  maxsize: int
+    The maximal number of entries. When the cache is full, the least recently used entry is dropped.
+  '''
+
+  def __init__(self, maxsize=4096):
+    self.maxsize = maxsize
+    self.hits = 0
+    self.misses = 0
+    self._entries = OrderedDict()
+    self._lock = Lock()
+
+  def lookup(self, key):
+    '''Return a pair (found, value). Raises TypeError if the key is not hashable'''
+
+    with self._lock:
+      try:
+        value = self._entries[key]
+      except KeyError:
+        self.misses += 1
+        return False, None
+      self._entries.move_to_end(key)
+      self.hits += 1
+      return True, value
+
+  def store(self, key, value):
+    with self._lock:
+      self._entries[key] = value
+      self._entries.move_to_end(key)
+      if len(self._entries) > self.maxsize:
+        self._entries.popitem(last=False)
+
+  def clear(self):
+    '''Drop all the entries. The statistics are kept'''
+
+    with self._lock:
+      self._entries.clear()
+
+  def info(self):
+    with self._lock:
+      return CacheInfo(self.hits, self.misses, self.maxsize, len(self._entries))
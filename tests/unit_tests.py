@@ -1,8 +1,21 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
 from functools import wraps
+import io
+import numpy as np
+from pathlib import Path
+import subprocess
 import sys
 import unittest
+from unittest.mock import patch
+sys.path.append('..')
 sys.path.append('../src')
-from hexagen import HexagonsGame, _Vec, _Hexagon, Tile, Shape, Line, Circle, Triangle
+from constants.constants import DIRECTIONS
+from src.board import board_hash
+from src.board_batch import BoardBatch
+from src.hex_arrays import cubes_to_linds, cubes_to_offsets, linds_to_offsets, offsets_to_cubes, offsets_to_linds
+from hexagen import GameSession, HexagonsGame, _Vec, _Hexagon, Tile, Shape, Line, Circle, Triangle
 
 class HexagonsTests(unittest.TestCase):
 
@@ -33,6 +46,276 @@ class HexagonsGameTests(HexagonsTests):
     self.assertShapeLinds(HexagonsGame.get_record(step_names=['1','2']), [78, 77, 79, 96, 61, 59, 60])
     self.assertShapeLinds(HexagonsGame.get_record(step_names='2'), [77, 79, 96, 61, 59, 60])
 
+  @HexagonsTests.wrap_test
+  def test_board_state(self):
+    HexagonsGame.start(3, 2)
+    Shape([0, 4], from_linds=True).draw('red')
+    self.assertEqual(HexagonsGame._board.dtype, np.uint8)
+    self.assertEqual(HexagonsGame.board_state, [4, 0, 0, 0, 4, 0])
+    self.assertEqual(list(HexagonsGame.board_state), [4, 0, 0, 0, 4, 0])
+    self.assertEqual(HexagonsGame.board_state[4], 4)
+    HexagonsGame.board_state[1] = 2
+    self.assertEqual(Tile(2, 1).color, 'yellow')
+    Shape([0, 1], from_linds=True).copy_paste(shift=_Vec(0, 1))
+    self.assertEqual(HexagonsGame.board_state, [4, 2, 0, 4, 2, 0])
+    board = np.asarray(HexagonsGame.board_state)
+    self.assertEqual(board.tolist(), [4, 2, 0, 4, 2, 0])
+    with self.assertRaises(ValueError):
+      board[2] = 1
+    copy = np.array(HexagonsGame.board_state, dtype=np.int64)
+    copy[2] = 1
+    self.assertEqual(HexagonsGame.board_state[2], 0)
+
+  @HexagonsTests.wrap_test
+  def test_draw_journal(self):
+    HexagonsGame.start(4, 3)
+    HexagonsGame._start_batch_record('batch 1')
+    Tile(1, 1).draw('yellow')
+    Tile(1, 1).neighbor('up').draw('blue')
+    HexagonsGame.record_step('1')
+    Shape([0, 1], from_linds=True).copy_paste(shift=_Vec('down'))
+    record = HexagonsGame._get_batch_record('batch 1')
+    self.assertEqual(record[0], {'index': 0, 'row': 1, 'column': 1, 'color': 'yellow'})
+    self.assertEqual(record[1], {'index': None, 'row': 0, 'column': 1, 'color': 'blue'})
+    self.assertEqual([draw['color'] for draw in record[2:]], ['yellow', 'white'])
+    self.assertEqual(record.linds.tolist(), [0, -1, 4, 5])
+    self.assertEqual(record.colors.tolist(), [2, 5, 2, 0])
+    self.assertEqual(len(record), 4)
+    HexagonsGame._start_batch_record('batch 2')
+    Tile(1, 1).neighbor('up').draw('red')
+    self.assertEqual(len(record), 4)
+    self.assertEqual(len(HexagonsGame._get_batch_record('batch 2')), 1)
+    # off-board tiles of a step are kept with their color
+    step = HexagonsGame.get_record('1')
+    self.assertShapeLinds(step, [4, 5, None])
+    self.assertEqual(step.colors, ['yellow', 'white', 'red'])
+    HexagonsGame.record_step('1')
+    self.assertTrue(HexagonsGame.get_record('1').is_empty())
+
+  @HexagonsTests.wrap_test
+  def test_undo(self):
+    HexagonsGame.start(4, 3)
+    self.assertFalse(HexagonsGame.undo())
+    Tile(1, 1).draw('red')
+    HexagonsGame.record_step('1')
+    Shape([0, 1, 2], from_linds=True).draw('blue')
+    HexagonsGame.board_state[5] = 1
+    Tile(2, 1).draw('green')
+    self.assertTrue(HexagonsGame.undo())
+    self.assertEqual(HexagonsGame.board_state, [5, 5, 5, 0, 0, 1, 0, 0, 0, 0, 0, 0])
+    self.assertTrue(HexagonsGame.undo())
+    self.assertEqual(HexagonsGame.board_state, [5, 5, 5, 0, 0, 0, 0, 0, 0, 0, 0, 0])
+    self.assertTrue(HexagonsGame.redo())
+    self.assertTrue(HexagonsGame.redo())
+    self.assertFalse(HexagonsGame.redo())
+    self.assertEqual(HexagonsGame.board_state, [5, 3, 5, 0, 0, 1, 0, 0, 0, 0, 0, 0])
+    self.assertShapeLinds(HexagonsGame.get_record('1'), [0, 1, 2])
+    self.assertEqual(Tile(2, 1).color, 'green')
+    # undoing the step restores the board at its start, and its record
+    self.assertEqual(HexagonsGame.undo_step(), 3)
+    self.assertEqual(HexagonsGame.board_state, [4] + [0] * 11)
+    self.assertTrue(HexagonsGame.get_record('1').is_empty())
+    self.assertEqual(Tile(2, 1).color, 'white')
+    # a new draw drops the undone draws
+    Tile(3, 1).draw('black')
+    self.assertFalse(HexagonsGame.redo())
+    self.assertShapeLinds(HexagonsGame.get_record('1'), [2])
+    # only the last draws can be undone
+    HexagonsGame.set_undo_limit(2)
+    for lind in range(3, 8):
+      Shape([lind], from_linds=True).draw('yellow')
+    while HexagonsGame.undo():
+      pass
+    self.assertEqual(HexagonsGame.board_state, [4, 0, 1, 2, 2, 2, 0, 0, 0, 0, 0, 0])
+
+  @HexagonsTests.wrap_test
+  def test_draw_events(self):
+    HexagonsGame.start(4, 3)
+    events = []
+    HexagonsGame.subscribe(events.append)
+    shape = Shape([0, 1], from_linds=True)
+    shape.draw('red')
+    HexagonsGame.record_step('1')
+    shape.copy_paste('down')
+    shape.recolor({'red': 'blue'})
+    HexagonsGame.board_state[11] = 1
+    HexagonsGame.undo()
+    HexagonsGame.unsubscribe(events.append)
+    Tile(3, 3).draw('red')
+    # one event per draw, holding the changed tiles
+    self.assertEqual([(event.linds.tolist(), event.colors.tolist(), event.old_colors.tolist(), event.step_name)
+                      for event in events],
+                     [([0, 1], [4, 4], [0, 0], None), ([4, 5], [4, 4], [0, 0], '1'), ([0, 1], [5, 5], [4, 4], '1'),
+                      ([11], [1], [0], '1'), ([11], [0], [1], '1')])
+
+  @HexagonsTests.wrap_test
+  def test_batch(self):
+    def program():
+      HexagonsGame.record_step('1')
+      shape = Shape([0, 1, 5], from_linds=True)
+      shape.draw('red')
+      Tile(1, 1).draw('blue')
+      Tile(0, 1).draw('green')
+      # reading a color applies the draws made so far
+      if Tile(1, 1).color == 'blue':
+        shape.copy_paste('down')
+      HexagonsGame.record_step('2')
+      Shape([2, 3], from_linds=True).draw('yellow')
+      Tile(3, 1).draw('black')
+      return Shape.get_color('red')
+
+    HexagonsGame.start(4, 3)
+    red = program()
+    board = HexagonsGame.board_state.tolist()
+    HexagonsGame.start(4, 3)
+    events = []
+    HexagonsGame.subscribe(events.append)
+    with HexagonsGame.batch():
+      batch_red = program()
+      self.assertEqual(len(events), 3)
+    self.assertEqual(HexagonsGame.board_state, board)
+    self.assertShapeLinds(batch_red, red._linds)
+    self.assertEqual(HexagonsGame.board_states['1'], [5, 4, 0, 0, 0, 4, 0, 0, 5, 4, 0, 0])
+    self.assertShapeLinds(HexagonsGame.get_record('2'), [2, 3])
+    # the draws of the second step were applied as a single draw
+    self.assertEqual(events[-1].linds.tolist(), [2, 3])
+    self.assertTrue(HexagonsGame.undo())
+    self.assertEqual(HexagonsGame.board_state, HexagonsGame.board_states['1'])
+
+  @HexagonsTests.wrap_test
+  def test_lazy(self):
+    def program(session):
+      HexagonsGame.record_step('1')
+      shape = Shape([0, 1], from_linds=True)
+      shape.draw('red')
+      Tile(1, 1).draw('blue')
+      copy = shape.copy_paste(shift=_Vec(1, 0))
+      copy.grid('down', 0, num_copies=1)
+      shape.draw('white')
+      blank = session._board.tolist() == [0] * 12
+      # recoloring tiles that have pending draws applies them
+      copy.recolor({'white': 'black', 'red': 'green', 'blue': 'yellow'})
+      shape.rotate(Tile(2, 2), 180)
+      return blank
+
+    HexagonsGame.start(4, 3)
+    program(HexagonsGame.current_session())
+    board = HexagonsGame.board_state.tolist()
+    record = HexagonsGame.get_record('1')
+    session = HexagonsGame.start(4, 3, lazy=True)
+    events = []
+    HexagonsGame.subscribe(events.append)
+    self.assertTrue(program(session))
+    self.assertEqual(HexagonsGame.board_state, board)
+    self.assertEqual(len(events), 2)
+    lazy_record = HexagonsGame.get_record('1')
+    self.assertEqual(lazy_record._linds, record._linds)
+    self.assertEqual(lazy_record.colors, record.colors)
+    # a copy reads the colors of the board before the draws that come after it
+    Shape([0, 1, 2], from_linds=True).draw('red')
+    Shape([1], from_linds=True).copy_paste(shift=_Vec(0, 1))
+    Shape([1, 2], from_linds=True).draw('blue')
+    HexagonsGame.set_lazy(False)
+    self.assertEqual(HexagonsGame.board_state[:6], [4, 5, 5, 0, 0, 4])
+    Tile(1, 1).draw('green')
+    self.assertEqual(HexagonsGame.board_state[0], 3)
+
+  @HexagonsTests.wrap_test
+  def test_board_hash(self):
+    HexagonsGame.start(4, 3)
+    blank = HexagonsGame.board_hash()
+    self.assertEqual(blank, board_hash([0] * 12))
+    Shape([0, 1, 5], from_linds=True).draw('red')
+    HexagonsGame.board_state[5] = 2
+    Shape([1, 2], from_linds=True).copy_paste('down')
+    self.assertEqual(HexagonsGame.board_hash(), board_hash(HexagonsGame.board_state.tolist()))
+    self.assertNotEqual(HexagonsGame.board_hash(), blank)
+    # the same board drawn in another order has the same hash
+    HexagonsGame.start(4, 3)
+    with HexagonsGame.batch():
+      Shape([5, 6], from_linds=True).draw('red')
+      Shape([0, 1], from_linds=True).draw('red')
+      Tile(2, 2).draw('yellow')
+    self.assertEqual(HexagonsGame.board_hash(), board_hash([4, 4, 0, 0, 0, 2, 4, 0, 0, 0, 0, 0]))
+    while HexagonsGame.undo():
+      pass
+    self.assertEqual(HexagonsGame.board_hash(), blank)
+
+  @HexagonsTests.wrap_test
+  def test_history(self):
+    session = HexagonsGame.start(4, 3)
+    # keep a checkpoint every few changes, so that boards are rebuilt from checkpoints too
+    session._history.checkpoint_interval = 3
+    boards = [HexagonsGame.board_state.tolist()]
+    HexagonsGame.record_step('1')
+    Tile(1, 1).draw('red')
+    boards.append(HexagonsGame.board_state.tolist())
+    Shape([1, 2, 3, 5], from_linds=True).draw('blue')
+    boards.append(HexagonsGame.board_state.tolist())
+    HexagonsGame.record_step('2')
+    Tile(1, 1).neighbors().draw('red')
+    boards.append(HexagonsGame.board_state.tolist())
+    Tile(10, 10).draw('green')
+    boards.append(HexagonsGame.board_state.tolist())
+    HexagonsGame.board_state[11] = 1
+    boards.append(HexagonsGame.board_state.tolist())
+    Shape([0, 11], from_linds=True).draw('white')
+    boards.append(HexagonsGame.board_state.tolist())
+
+    self.assertEqual(HexagonsGame.num_draws(), 6)
+    for draw, board in enumerate(boards):
+      self.assertEqual(HexagonsGame.board_at(draw=draw), board)
+    self.assertEqual(HexagonsGame.board_at('1'), boards[2])
+    self.assertEqual(HexagonsGame.board_at('2'), boards[-1])
+    self.assertEqual(list(HexagonsGame.board_states.keys()), ['1'])
+    self.assertEqual(HexagonsGame.board_states['1'], boards[2])
+    # tile 11 was changed in step 2, but it is back to white
+    self.assertShapeLinds(HexagonsGame.diff_steps('1', '2'), [0, 1, 4])
+    self.assertShapeLinds(HexagonsGame.diff_steps('2', '2'), [])
+    self.assertEqual([colors.tolist() for colors in HexagonsGame._history.diff(6, 2)], [[0, 1, 4], [0, 4, 4], [4, 5, 0]])
+    self.assertEqual([colors.tolist() for colors in HexagonsGame._history.draw_changes(6)], [[0, 11], [4, 1], [0, 0]])
+    self.assertEqual(HexagonsGame._undo.done[-1].draw, 6)
+
+  @HexagonsTests.wrap_test
+  def test_sessions(self):
+    first = HexagonsGame.start(3, 2)
+    Tile(1, 1).draw('red')
+    second = HexagonsGame.start(4, 4)
+    self.assertIs(HexagonsGame.current_session(), second)
+    with HexagonsGame.use_session(first):
+      self.assertEqual(HexagonsGame.width, 3)
+      Tile(2, 1).draw('blue')
+    self.assertEqual(first.board_state, [4, 5, 0, 0, 0, 0])
+    self.assertEqual(HexagonsGame.board_state, [0] * 16)
+
+    def program(k):
+      # programs on boards of different sizes, drawing tile by tile so that threads interleave
+      session = HexagonsGame.start(3 + k, 2 + k)
+      HexagonsGame.record_step('1')
+      for tile in Shape.get_entire_board():
+        tile.draw('black')
+      return session, HexagonsGame.board_state.tolist(), HexagonsGame.get_record('1')._size
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+      results = list(executor.map(program, range(8)))
+    for k, (session, board, num_drawn) in enumerate(results):
+      self.assertEqual((session.width, session.height), (3 + k, 2 + k))
+      self.assertEqual(board, [1] * ((3 + k) * (2 + k)))
+      self.assertEqual(num_drawn, (3 + k) * (2 + k))
+
+    async def async_program(k):
+      HexagonsGame.start(3 + k, 2)
+      for tile in Shape.get_entire_board():
+        tile.draw(k + 1)
+        await asyncio.sleep(0)
+      return HexagonsGame.board_state.tolist()
+
+    async def run_programs():
+      return await asyncio.gather(*[async_program(k) for k in range(3)])
+
+    self.assertEqual(asyncio.run(run_programs()), [[k + 1] * ((3 + k) * 2) for k in range(3)])
+    self.assertIsInstance(GameSession(2, 2).board_state, type(HexagonsGame.board_state))
+
 class _VecTests(HexagonsTests):
   @HexagonsTests.wrap_test
   def test(self):
@@ -52,6 +335,11 @@ class _VecTests(HexagonsTests):
     self.assertEqual(_Vec(0, -3, 3)._has_direction(), True)
     self.assertEqual(_Vec(1, -4, 3)._has_direction(), False)
     self.assertEqual(_Vec(0, -3, 3)._has_direction(), True)
+    self.assertEqual(_Vec(2.5, -1.5, -1)._round()._cube, (3, -2, -1))
+    self.assertEqual(_Vec(3, 0, -3)._normalize()._cube, (1, 0, -1))
+    self.assertEqual(_Vec(1, -1, 0) + _Vec('down_left'), _Vec(0, 0, 0))
+    self.assertEqual(len({_Vec('up'), _Vec(0, -1, 1), _Vec('down')}), 2)
+    self.assertFalse(hasattr(_Vec('up'), '__dict__'))
 
 class _HexagonTests(HexagonsTests):
   @HexagonsTests.wrap_test
@@ -68,6 +356,9 @@ class _HexagonTests(HexagonsTests):
 
     HexagonsGame.start()
     self.assertEqual((_Hexagon(7, 6) - _Hexagon(8, 5))._cube, (-1, 1, 0))
+    self.assertEqual(_Hexagon(7, 6), _Hexagon(cube=(6, 2, -8)))
+    self.assertEqual(len({_Hexagon(7, 6), _Hexagon(cube=(6, 2, -8)), _Hexagon(-1, 6)}), 2)
+    self.assertFalse(hasattr(_Hexagon(7, 6), '__dict__'))
 
     HexagonsGame.start(2, 2)
     _Hexagon(1,2)._draw('black')
@@ -94,6 +385,49 @@ class _HexagonTests(HexagonsTests):
     self.assertEqual(_Hexagon(3,1)._neighbor('down')._offset, (3, 2))
     self.assertShapeLinds(Shape(_Hexagon(3,1)._neighbors(), from_hexagons=True), [None, 6, 3, 1])
 
+  @HexagonsTests.wrap_test
+  def test_neighbor_table(self):
+    HexagonsGame.start(5, 4)
+    self.assertEqual(HexagonsGame._neighbor_linds.shape, (20, 6))
+    self.assertEqual(HexagonsGame._neighbor_linds[6].tolist(), [1, 11, 12, 5, 10, 7])
+    self.assertEqual(HexagonsGame._neighbor_linds[0].tolist(), [-1, 5, 1, -1, -1, -1])
+    for lind in range(20):
+      shifted = [_Hexagon._from_lind(lind)._shift(_Vec(*cube))._lind for cube in DIRECTIONS.values()]
+      self.assertEqual([l if l >= 0 else None for l in HexagonsGame._neighbor_linds[lind].tolist()], shifted)
+
+  @HexagonsTests.wrap_test
+  def test_interned(self):
+    HexagonsGame.start(4, 6)
+    self.assertIs(_Hexagon._from_lind(5), _Hexagon._from_cube((1, 1, -2)))
+    self.assertIs(Tile(2, 2)._hexagon, _Hexagon._from_lind(5))
+    self.assertIs(_Hexagon._from_lind(4)._shift(_Vec('down_right')), _Hexagon._from_offset(2, 2))
+    self.assertFalse(_Hexagon._from_cube((-1, 0, 1))._on_board())
+    self.assertIsNot(_Hexagon._from_cube((-1, 0, 1)), _Hexagon._from_cube((-1, 0, 1)))
+    HexagonsGame.start(5, 6)
+    self.assertEqual(_Hexagon._from_lind(5)._offset, (1, 2))
+
+  @HexagonsTests.wrap_test
+  def test_coordinate_arrays(self):
+    HexagonsGame.start(5, 4)
+    offsets = [(column, row) for column in range(-1, 8) for row in range(-1, 7)]
+    columns, rows = np.array(offsets).T
+    hexagons = [_Hexagon(column, row) for column, row in offsets]
+    cubes = offsets_to_cubes(columns, rows)
+    self.assertEqual(list(map(tuple, cubes.tolist())), [hexagon._cube for hexagon in hexagons])
+    self.assertEqual([tuple(_) for _ in np.stack(cubes_to_offsets(cubes), axis=1).tolist()], offsets)
+    linds = offsets_to_linds(columns, rows, 5, 4)
+    self.assertEqual(linds.tolist(), [-1 if hexagon._lind is None else hexagon._lind for hexagon in hexagons])
+    self.assertEqual(cubes_to_linds(cubes, 5, 4).tolist(), linds.tolist())
+    on_board = linds >= 0
+    self.assertEqual([tuple(_) for _ in np.stack(linds_to_offsets(linds[on_board], 5), axis=1).tolist()],
+                     [offset for offset, lind in zip(offsets, linds) if lind >= 0])
+    # shapes read their coordinates from the same tables, in the order of their tiles
+    shape = Shape([Tile(3, 2), Tile(0, 1), Tile(1, 1)])
+    self.assertEqual(shape.columns, [3, 0, 1])
+    self.assertEqual(shape.rows, [2, 1, 1])
+    self.assertEqual(shape._cubes, [_Hexagon(3, 2)._cube, _Hexagon(0, 1)._cube, (0, 0, 0)])
+    self.assertEqual(Shape.from_linds([6, 1])._qs, [1, 1])
+
 class ShapeTests(HexagonsTests):
 #   def _size(self):
 #   def _linds(self):
@@ -188,12 +522,18 @@ class ShapeTests(HexagonsTests):
     self.assertShapeLinds(S.get(criterion='inside'), [98, 99, 100, 80, 81, 82, 63])
     self.assertShapeLinds(S.get(criterion='above'), [7, 8, 9, 10, 43, 44, 11, 46, 47, 25, 26, 27, 28, 29])
     self.assertShapeLinds(S.get(criterion='below'), [133, 134, 135, 136, 169, 170, 171, 172, 137, 173, 115, 119, 151, 153, 154, 155, 152])
+    # directional queries list the tiles line by line, and by linear index on each line
+    self.assertEqual(S.get(criterion='above')._linds, [7, 25, 43, 8, 26, 44, 9, 27, 10, 28, 46, 11, 29, 47])
+    self.assertEqual(S.neighbors(criterion='above')._linds, [27, 46, 44, 43, 47])
     self.assertShapeLinds(S.get(criterion='top'), [61, 62, 45, 64, 65])
 
     S=Shape([64, 65, 66, 134, 135, 136, 78, 79, 80, 82, 83, 84, 27, 96, 97, 98, 99, 100, 101, 102, 43, 44, 45, 46, 47, 114, 115, 116, 117, 118, 119, 120, 60, 61, 62, 63], from_linds=True)
     self.assertShapeLinds(S.get(criterion='corners'), [66, 135, 114, 120, 27, 60])
+    # corners and endpoints are listed in the order of the outer boundary
+    self.assertEqual(S.get(criterion='corners')._linds, [135, 27, 66, 120, 114, 60])
     S=Shape([38, 39, 58, 59, 78], from_linds=True)
     self.assertShapeLinds(S.get(criterion='endpoints'), [78, 38])
+    self.assertEqual(S.get(criterion='endpoints')._linds, [78, 38])
 
     S=Shape([64, 65, 66, 134, 135, 136, 78, 79, 80, 82, 83, 84, 27, 96, 97, 98, 99, 100, 101, 102, 43, 44, 45, 46, 47, 114, 115, 116, 117, 118, 119, 120, 60, 61, 62, 63], from_linds=True)
     self.assertShapeLinds(S.boundary(), [96, 66, 134, 102, 135, 136, 43, 44, 46, 47, 78, 114, 115, 84, 119, 120, 27, 60, 98, 99, 100, 80, 82, 63])
@@ -226,6 +566,208 @@ class ShapeTests(HexagonsTests):
     HexagonsGame.start()
     self.assertEqual(Shape([Tile(4, 3), Tile(3, 5), Tile(4, 5), Tile(5, 5), Tile(3, 4), Tile(5, 4)]).center().offset, (4, 4))
 
+  @HexagonsTests.wrap_test
+  def test_regions(self):
+    HexagonsGame.start(6, 5)
+    ring = Tile(3, 3).neighbors()
+    self.assertShapeLinds(ring.get('inside'), [14])
+    self.assertEqual(ring.get('outside')._size, 30 - 7)
+    self.assertShapeLinds(ring.boundary('inner'), ring._linds)
+    self.assertShapeLinds(ring.neighbors('inside'), [14])
+    self.assertTrue(ring.get('outside').overlaps(Shape.get_board_perimeter()))
+    corner_ring = Tile(1, 1).neighbors()
+    self.assertTrue(corner_ring.get('inside').is_empty())
+    self.assertShapeLinds(corner_ring.boundary('outer'), [None, 1, 6])
+    self.assertEqual(corner_ring.boundary('outer')._size, 6)
+    self.assertShapeLinds(corner_ring.neighbors('outside'), [0, 2, 7, 8, 12])
+
+  @HexagonsTests.wrap_test
+  def test_region_order(self):
+    # the regions list their tiles in the order of the set operations that define them
+    HexagonsGame.start(6, 5)
+    S = Shape([Tile(2, 2), Tile(3, 2), Tile(4, 2), Tile(2, 3), Tile(4, 3), Tile(2, 4), Tile(3, 4), Tile(4, 4), Tile(5, 4)])
+    self.assertEqual(S.get('outside')._linds, [3, 11, 0, 17, 18, 10, 2, 16, 6, 12, 29, 5, 1, 27, 28, 4, 26, 23, 24, 25])
+    self.assertEqual(S.get('inside')._linds, [14])
+    self.assertEqual(S.boundary('outer')._linds, [22, 13, 9, 20, 8, 15, 21, 7, 19])
+    self.assertEqual(S.boundary('inner')._linds, [13, 9, 20, 8, 15, 7])
+    self.assertEqual(S.boundary()._linds, [22, 9, 13, 20, 8, 15, 21, 7, 19])
+    self.assertEqual(S.neighbors('outside')._linds, [3, 1, 27, 25, 28, 17, 18, 26, 10, 2, 23, 24, 16, 6, 12])
+    self.assertEqual(S.boundary('outer')[0].offset, (5, 4))
+
+  @HexagonsTests.wrap_test
+  def test_reflections(self):
+    HexagonsGame.start()
+    S = Shape([40, 41, 42, 60], from_linds=True)
+    S.draw('red')
+    for kwargs in [dict(column=10), dict(axis_direction='horizontal', tile_on_axis=Tile(9, 8)),
+                   dict(axis_direction='up_right', tile_on_axis=Tile(9, 5)),
+                   dict(axis_line=Line(Tile(7, 5), direction='down_left'))]:
+      R = S.reflect(**kwargs)
+      self.assertEqual(R.colors, ['red'] * 4)
+      # reflecting twice through the same axis gives back the original tiles
+      self.assertShapeLinds(R.reflect(**kwargs), [40, 41, 42, 60])
+    self.assertShapeLinds(Tile(2, 2).reflect(axis_direction='horizontal', tile_on_axis=Tile(5, 3)), [37])
+
+  @HexagonsTests.wrap_test
+  def test_rotations(self):
+    HexagonsGame.start()
+    S = Shape([40, 41, 42], from_linds=True)
+    rotations = S.rotations(Tile(9, 5))
+    self.assertEqual(len(rotations), 6)
+    self.assertShapeLinds(rotations[0], [40, 41, 42])
+    self.assertShapeLinds(rotations[2], [152, 115, 134])
+    self.assertBoardNonZeros([])
+    for k, rotation in enumerate(rotations):
+      self.assertEqual(set(rotation.rotations(Tile(9, 5))[1]._cubes), set(rotations[(k + 1) % 6]._cubes))
+    q, r, s = Tile(9, 5)._hexagon._cube
+    # counterclockwise, the tile above the center goes to its upper left
+    self.assertEqual(Tile(9, 4).rotations(Tile(9, 5))[1]._cubes, [(q - 1, r, s + 1)])
+    # a rotation by 360 degrees (or 0) maps every tile to itself
+    S.draw('red')
+    self.assertShapeLinds(S.rotate(Tile(2, 2), 360), [40, 41, 42])
+    # off-board tiles are rotated too
+    self.assertShapeLinds(Tile(5, 5).rotate(Tile(2, 2), 180), [None])
+    with self.assertRaises(Exception):
+      S.rotate(Tile(9, 5), 90)
+
+  @HexagonsTests.wrap_test
+  def test_directional_queries(self):
+    HexagonsGame.start(5, 4)
+    self.assertShapeLinds(Tile(3, 3).get('above'), [2, 7])
+    self.assertShapeLinds(Tile(3, 3).get('below'), [17])
+    S = Shape([Tile(2, 2), Tile(2, 3), Tile(4, 1), Tile(0, 2)])
+    for direction in DIRECTIONS:
+      # walk from every tile of S in the direction, until leaving the board
+      linds = set()
+      for tile in S:
+        hexagon = tile._hexagon._shift(_Vec(direction))
+        while -2 <= hexagon._column <= 7 and -2 <= hexagon._row <= 6:
+          if hexagon._lind is not None and hexagon not in S._hexagons:
+            linds.add(hexagon._lind)
+          hexagon = hexagon._shift(_Vec(direction))
+      beyond = set(S.get(direction)._linds)
+      self.assertTrue(beyond <= linds)
+      self.assertEqual(len(S._max(direction)._linds), len(set(S._cubes[i][DIRECTIONS[direction].index(0)] for i in range(4))))
+    self.assertShapeLinds(S.get('up_right'), [1, 2, 4, 5, 8, 9, 12])
+    self.assertShapeLinds(S.edge('left'), [None])
+    self.assertShapeLinds(S._max('up'), [None, 6, 3])
+    self.assertShapeLinds(S.extreme('up'), [3])
+
+  @HexagonsTests.wrap_test
+  def test_query_cache(self):
+    HexagonsGame.start()
+    S = Shape([61, 117, 65, 62, 116, 83, 118, 64, 79, 101, 45, 97], from_linds=True)
+    inside = S.get('inside')
+    hits = Shape.query_cache_info().hits
+    self.assertShapeLinds(Shape([61, 117, 65, 62, 116, 83, 118, 64, 79, 101, 45, 97], from_linds=True).get('inside'),
+                          inside._linds)
+    self.assertEqual(Shape.query_cache_info().hits, hits + 1)
+    self.assertIsNot(S.get('inside'), inside)
+    self.assertEqual(S.neighbors('white')._size, 24)
+    S.neighbors()[0].draw('red')
+    self.assertEqual(S.neighbors('white')._size, 23)
+    self.assertEqual(Shape.get_color('red')._size, 1)
+    HexagonsGame.board_state[0] = 4
+    self.assertEqual(Shape.get_color('red')._size, 2)
+    # the cache is shared by the sessions, starting a board doesn't clear it
+    size = Shape.query_cache_info().currsize
+    HexagonsGame.start()
+    self.assertEqual(Shape.query_cache_info().currsize, size)
+    hits = Shape.query_cache_info().hits
+    self.assertShapeLinds(S.get('inside'), inside._linds)
+    self.assertEqual(Shape.query_cache_info().hits, hits + 1)
+    edge = Tile(1, 1).neighbors()
+    edge_copy = edge.get('top')
+    edge_copy.draw('red')
+    self.assertEqual(edge.get('top').colors, ['white'] * edge_copy._size)
+
+  @HexagonsTests.wrap_test
+  def test_iteration(self):
+    HexagonsGame.start()
+    S = Shape([0, 1, 2], from_linds=True)
+    pairs = [(t1._lind, t2._lind) for t1 in S for t2 in S]
+    self.assertEqual(len(pairs), 9)
+    self.assertEqual(S[1]._lind, 1)
+    self.assertEqual(S[-1]._lind, 2)
+    self.assertEqual([tile._lind for tile in S[:2]], [0, 1])
+    self.assertEqual(S.rows, [1, 1, 1])
+    self.assertEqual(S.colors, ['white', 'white', 'white'])
+    S[1].draw('red')
+    self.assertEqual(S.colors, ['white', 'red', 'white'])
+    tiles = S.tiles
+    tiles.pop()
+    self.assertEqual(len(S.tiles), 3)
+
+  @HexagonsTests.wrap_test
+  def test_from_linds(self):
+    HexagonsGame.start()
+    self.assertEqual(Shape.from_linds(np.array([5, 2, 5, 9]))._linds, [2, 5, 9])
+    self.assertTrue(Shape.from_linds([]).is_empty())
+    self.assertIsInstance(Shape.from_linds([7]), Tile)
+    self.assertRaises(Exception, Shape.from_linds, [180])
+    self.assertEqual(Shape([Tile(3, 1), Tile(1, 1), Tile(3, 1)])._linds, [2, 0])
+    HexagonsGame.start(100, 100)
+    self.assertEqual(Shape.get_entire_board()._size, 10000)
+    self.assertEqual(Shape.get_board_perimeter()._size, 396)
+    self.assertEqual(Shape(Shape.get_entire_board().tiles)._size, 10000)
+
+  @HexagonsTests.wrap_test
+  def test_bitmask(self):
+    HexagonsGame.start()
+    S = Shape([0, 1, 19], from_linds=True)
+    self.assertEqual(S._mask, 0b10000000000000000011)
+    self.assertShapeLinds(S - Shape([1], from_linds=True), [0, 19])
+    self.assertEqual(Shape.get_entire_board()._size, 180)
+    edge = Tile(1, 1).neighbors()
+    self.assertShapeLinds(edge, [None, 1, 18])
+    self.assertEqual(edge._size, 6)
+    self.assertEqual((edge + edge)._size, 6)
+    self.assertEqual((edge * Shape.get_entire_board())._size, 2)
+    self.assertEqual((edge - Shape.get_entire_board())._size, 4)
+    self.assertTrue(edge.overlaps(Tile(1, 1).neighbor('up')))
+    # set operations keep the order of the python sets of the cubes of the tiles
+    A, B = Shape([Tile(3, 2), Tile(1, 1), Tile(5, 5), Tile(4, 6)]), Shape([Tile(5, 5), Tile(2, 2), Tile(0, 3)])
+    self.assertEqual((A + B)._cubes, list(set(A._cubes) | set(B._cubes)))
+    self.assertEqual((A * B)._cubes, list(set(A._cubes) & set(B._cubes)))
+    self.assertEqual((A - B)._cubes, list(set(A._cubes) - set(B._cubes)))
+    self.assertEqual(((A + B) - A)._cubes, list((set(A._cubes) | set(B._cubes)) - set(A._cubes)))
+    neighbor_cubes = [neighbor._cube for hexagon in A._hexagons for neighbor in hexagon._neighbors()]
+    self.assertEqual(A.neighbors()._cubes, list(set(neighbor_cubes) - set(A._cubes)))
+
+  @HexagonsTests.wrap_test
+  def test_distances(self):
+    for width, height in [(18, 10), (60, 50)]:
+      HexagonsGame.start(width, height)
+      S = Shape([Tile(0, 1), Tile(width, 3), Tile(7, 6)])
+      board = Shape.get_entire_board()
+      grown = S * board
+      for k in range(6):
+        self.assertShapeLinds(S.within(k), grown._linds)
+        previous, grown = grown, (grown + grown.neighbors()) * board
+        self.assertShapeLinds(S.ring(k + 1), (grown - previous)._linds)
+    self.assertTrue(Shape([]).within(3).is_empty())
+    self.assertEqual(Tile(3, 3).ring(0)._linds, Tile(3, 3)._linds)
+    self.assertEqual(Shape([Tile(1, 1), Tile(2, 2)]).distances(Shape([Tile(4, 3), Tile(1, 1)])).tolist(), [[4, 0], [2, 2]])
+
+  @HexagonsTests.wrap_test
+  def test_distance_field(self):
+    HexagonsGame.start()
+    S = Shape([Tile(2, 2), Tile(12, 7)])
+    field = S.distance_field()
+    self.assertEqual(field.shape, (180,))
+    self.assertShapeLinds(S, np.flatnonzero(field == 0).tolist())
+    grown = S
+    for k in range(1, 8):
+      previous, grown = grown, (grown + grown.neighbors()) * Shape.get_entire_board()
+      self.assertShapeLinds(S.level_set(k), (grown - previous)._linds)
+    with self.assertRaises(ValueError):
+      field[:] = 0
+    self.assertEqual(S.distance_field().max(), 9)
+    self.assertEqual(S.level_set(0)._linds, S._linds)
+    self.assertShapeLinds(S.level_set(3), S.ring(3)._linds)
+    self.assertTrue(S.level_set(20).is_empty())
+    self.assertEqual(Shape([]).distance_field().tolist(), [-1] * 180)
+
 class TileTests(HexagonsTests):
   @HexagonsTests.wrap_test
   def test(self):
@@ -240,6 +782,11 @@ class TileTests(HexagonsTests):
     self.assertEqual(Tile(1, 1).neighbor(direction='down')._lind, 18)
     self.assertEqual(Tile(1, 1).neighbor(direction='down').on_board(), True)
     self.assertEqual(Tile(1, 1).neighbor(direction='up').on_board(), False)
+    self.assertEqual(Tile(1, 1).distance_to(Tile(4, 3)), 4)
+    self.assertEqual(Tile(1, 1).distance_to(Shape([Tile(4, 3), Tile(1, 3)])), 2)
+    self.assertEqual(Tile(1, 1).distance_to(Tile(1, 1).neighbor('up')), 1)
+    self.assertEqual(Tile(1, 1).distance_to(Tile(0, 1)), 1)
+    self.assertIsNone(Tile(1, 1).distance_to(Shape([])))
 
 
 class LineTests(HexagonsTests):
@@ -283,5 +830,75 @@ class TriangleTests(HexagonsTests):
     Triangle(start_tile=Tile(8, 6), point='left', start_tile_type='bottom', side_length=3).draw('black')
     self.assertBoardNonZeros([97, 96, 77, 78, 61, 79])
 
+class BoardBatchTests(HexagonsTests):
+  @HexagonsTests.wrap_test
+  def test_board_batch(self):
+    boards = []
+    HexagonsGame.start(4, 3)
+    Shape([0, 1, 6], from_linds=True).draw('red')
+    Shape([2, 5, 11], from_linds=True).draw('blue')
+    boards.append(HexagonsGame.board_state.tolist())
+    Tile(1, 1).neighbors().draw('red')
+    boards.append(HexagonsGame.board_state.tolist())
+    batch = BoardBatch([boards[0], boards[1]], 4, 3, keys=['a', 'b'])
+    self.assertEqual(batch.grids().shape, (2, 3, 4))
+    self.assertEqual(np.flatnonzero(batch.get_color('red')[1]).tolist(), Shape.get_color('red')._linds)
+    # the same neighbors as on a single board
+    self.assertEqual(batch.neighbor(batch.boards, 'down_right')[1].tolist(),
+                     [-1 if tile.neighbor('down_right')._lind is None else HexagonsGame.board_state[tile.neighbor('down_right')._lind]
+                      for tile in Shape.get_entire_board().tiles])
+    self.assertEqual(np.flatnonzero(batch.touching('red', 'blue')[0]).tolist(), [1, 6])
+    labels, num_regions = batch.label_regions()
+    self.assertEqual(num_regions.tolist(), [4, 4])
+    self.assertEqual(labels[0].tolist(), [1, 1, 2, 0, 0, 3, 1, 0, 0, 0, 0, 4])
+    self.assertEqual(batch.label_regions('blue')[1].tolist(), [3, 3])
+    self.assertEqual(batch.color_counts()[:, [0, 4, 5]].tolist(), [[6, 3, 3], [5, 4, 3]])
+    self.assertEqual(batch.num_differences(boards[1]).tolist(), [1, 0])
+    self.assertEqual(batch[batch.matches(boards[1])].keys, ['b'])
+    precision, recall = batch.precision_recall(boards[1])
+    self.assertEqual(precision.tolist(), [1, 1])
+    self.assertEqual(recall.tolist(), [6 / 7, 1])
+
+class ProgramTests(HexagonsTests):
+  # programs that index into the results of set operations, and the painted tiles of their final boards
+  # ({lind: color id}) as they were drawn before shapes kept their tiles in bitmasks
+  baseline_boards = {
+    'gold/gpt/33/e.py': {25: 7, 29: 7, 42: 7, 43: 7, 44: 7, 46: 7, 47: 7, 48: 7, 60: 7, 61: 7, 62: 7, 64: 7, 65: 7,
+                         66: 7, 97: 7, 101: 7, 114: 7, 115: 7, 116: 7, 117: 7, 118: 7, 119: 7, 120: 7, 132: 7, 133: 7,
+                         134: 7, 135: 7, 136: 7, 137: 7, 138: 7, 151: 7, 152: 7, 153: 7, 154: 7, 155: 7, 170: 7,
+                         171: 7, 172: 7, 173: 7},
+    'gold/gpt/39/d.py': {25: 3, 43: 3, 45: 5, 47: 5, 63: 5, 80: 4, 82: 4, 98: 4, 99: 4, 100: 4},
+    'gold/gpt/41/a.py': {67: 3, 68: 5, 69: 5, 84: 4, 86: 5, 87: 5, 88: 5, 101: 3, 102: 3, 103: 3, 104: 4, 105: 5,
+                         106: 5, 122: 3},
+  }
+
+  @HexagonsTests.wrap_test
+  def test_baseline_boards(self):
+    root = Path(__file__).resolve().parent.parent
+    for program, painted in ProgramTests.baseline_boards.items():
+      path = root / program
+      namespace = {'__name__': '__main__', '__file__': str(path)}
+      # the programs import the engine as src.hexagen, and plot the board at the end
+      with patch('src.hexagen.HexagonsGame.plot'), contextlib.redirect_stdout(io.StringIO()):
+        exec(compile(path.read_text(), str(path), 'exec'), namespace)
+      board = namespace['HexagonsGame'].board_state.tolist()
+      self.assertEqual({lind: color for lind, color in enumerate(board) if color}, painted, program)
+
+class ImportTests(HexagonsTests):
+  @HexagonsTests.wrap_test
+  def test_import_time(self):
+    # import the engine in a fresh interpreter: plotting and scipy should not be loaded
+    code = '\n'.join(['import sys, time',
+                      'start = time.perf_counter()',
+                      'import src.hexagen, utils.reading_tasks',
+                      'print(time.perf_counter() - start)',
+                      "print(' '.join(m for m in ['matplotlib', 'scipy'] if m in sys.modules))"])
+    output = subprocess.run([sys.executable, '-c', code], cwd=Path(__file__).resolve().parent.parent,
+                            capture_output=True, text=True, check=True).stdout.splitlines()
+    import_time, loaded_modules = output[-2:]
+    print(f'import time: {float(import_time):.3f} seconds')
+    self.assertEqual(loaded_modules, '')
+    self.assertLess(float(import_time), 2)
+
 if __name__ == '__main__':
   unittest.main()
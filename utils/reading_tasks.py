@@ -4,14 +4,17 @@ and return them in useful formats.
 
 read_task
 search_tasks_by_keyword
+gold_board_hashes
 '''
 
+from collections import defaultdict
 from constants.constants import ROOT_DIR
 import json
 from os.path import join
 import re
 import textwrap
-from src.plot_board import plot_boards
+
+from src.board import board_hash
 
 # jsonl files that contain all the tasks
 data_dir = ROOT_DIR / 'data'
@@ -134,7 +137,25 @@ def search_tasks_by_keyword(reg_exp, at_least=1, avoid_reg_exp=None, which_tasks
   print(f'Found {reg_exp} in {len(tasks_inds_that_contain_keyword)} tasks')
   return tasks_inds_that_contain_keyword
 
+def gold_board_hashes(which_tasks=['train','dev','test']):
+  '''Hash all the gold boards of the dataset, with the hash of HexagonsGame.board_hash
+
+  Returns:
+  ------------
+  Dict[int, List[Tuple[int, int]]]
+    maps the hash of a board to the (task index, step number) pairs of the gold boards that are equal to it.
+    Steps are numbered from 1
+  '''
+
+  hashes = defaultdict(list)
+  for task in read_tasks(which_tasks=which_tasks):
+    for step, board in enumerate(extract_boards(task), start=1):
+      hashes[board_hash(board)].append((task['index'], step))
+  return dict(hashes)
+
 def plot_task(task_id, by_steps=False):
+  # matplotlib is only imported when plotting
+  from src.plot_board import plot_boards
   d = read_task(task_id, True)
   if by_steps:
     plot_boards(d['gold_boards'])